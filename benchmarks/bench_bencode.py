@@ -0,0 +1,134 @@
+"""Bencode decode benchmark on large synthetic torrents and scrape responses.
+
+Decodes the same documents with a copy of the original recursive decoder and
+with Bencode.decode, both copying strings and lazily returning memoryviews for
+long ones. Reports the best decode time and the peak memory traced while
+decoding (the input buffer itself is not counted). The original decoder cannot
+decode scrape responses at all, their keys are binary info hashes.
+
+    python benchmarks/bench_bencode.py [--pieces 200000] [--files 50000] [--scrape 20000]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bencode import Bencode
+
+
+def legacy_decode(data):
+    # the original recursive decoder, slicing one byte per token
+    def decode_next(data, index):
+        if data[index: index + 1] == b'i':
+            end = data.find(b'e', index)
+            if end == -1:
+                raise ValueError(f"invalid integer at index {index}")
+            return int(data[index+1:end]), end + 1
+        elif data[index:index+1] == b'l':
+            result = []
+            index += 1
+            while data[index:index + 1] != b'e':
+                item, index = decode_next(data, index)
+                result.append(item)
+            return result, index + 1
+        elif data[index:index+1] == b'd':
+            result = {}
+            index += 1
+            while data[index:index+1] != b'e':
+                key, index = decode_next(data, index)
+                value, index = decode_next(data, index)
+                result[key.decode()] = value
+            return result, index + 1
+        elif data[index:index+1].isdigit():
+            colon = data.find(b':', index)
+            if colon == -1:
+                raise ValueError(f"invalid string at index {index}")
+            length = int(data[index:colon])
+            return data[colon + 1: colon + 1 + length], colon + 1 + length
+        else:
+            raise ValueError(f"invalid bencode at index {index}")
+    result, _ = decode_next(data, 0)
+    return result
+
+
+def single_file_torrent(pieces):
+    return Bencode.encode({
+        'announce': 'http://127.0.0.1:6969/announce',
+        'info': {'name': 'big.iso', 'piece length': 262144, 'length': pieces * 262144,
+                 'pieces': os.urandom(20 * pieces)},
+    })
+
+
+def multi_file_torrent(files):
+    return Bencode.encode({
+        'announce': 'http://127.0.0.1:6969/announce',
+        'info': {'name': 'many', 'piece length': 16384,
+                 'files': [{'length': 1000 + i, 'path': ['dir%d' % (i % 100), 'file%d.bin' % i]} for i in range(files)],
+                 'pieces': os.urandom(20 * (files * 1500 // 16384 + 1))},
+    })
+
+
+def scrape_response(torrents):
+    return Bencode.encode({
+        'files': {os.urandom(20): {'complete': i, 'downloaded': i * 3, 'incomplete': i % 7} for i in range(torrents)},
+    })
+
+
+def measure(func, data, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    result = func(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pieces', type=int, default=200000)
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--scrape', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    documents = [
+        (f'torrent, {args.pieces} pieces', single_file_torrent(args.pieces)),
+        (f'torrent, {args.files} files', multi_file_torrent(args.files)),
+        (f'scrape, {args.scrape} torrents', scrape_response(args.scrape)),
+    ]
+    decoders = [
+        ('legacy', legacy_decode),
+        ('decode', Bencode.decode),
+        ('decode lazy', lambda data: Bencode.decode(data, lazy=True)),
+    ]
+    for name, data in documents:
+        print(f"{name} ({len(data) / 1e6:.1f} MB)")
+        for label, func in decoders:
+            try:
+                elapsed, peak = measure(func, data, args.repeat)
+            except (UnicodeDecodeError, RecursionError) as e:
+                print(f"  {label:<12} fails: {type(e).__name__}")
+                continue
+            print(f"  {label:<12} {elapsed * 1000:8.1f} ms  peak {peak / 1e6:7.1f} MB")
+
+    depth = 100000
+    nested = b'l' * depth + b'e' * depth
+    try:
+        legacy_decode(nested)
+        legacy = 'ok'
+    except RecursionError:
+        legacy = 'RecursionError'
+    Bencode.decode(nested)
+    print(f"{depth} nested lists: legacy {legacy}, decode ok")
+
+
+if __name__ == '__main__':
+    main()
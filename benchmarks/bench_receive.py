@@ -0,0 +1,213 @@
+"""Receive path microbenchmark on a loopback peer.
+
+Downloads the same pieces twice from a local seeder process: once through a
+copy of the original blocking receive code (``data += chunk``, slicing and
+``b''.join``) and once through PeerConnection, which receives block payloads
+straight into a preallocated piece buffer. Reports throughput and, per byte
+of block payload, how many bytes were allocated and copied in user space.
+
+    python benchmarks/bench_receive.py [--pieces 256] [--piece-length 262144]
+"""
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peer import PeerConnection
+
+BLOCK_SIZE = 16384
+INFO_HASH = b'\x11' * 20
+
+
+def start_seeder(piece_length):
+    # a seeder process answering every REQUEST with the same piece payload,
+    # kept out of this process so it doesn't compete for the GIL
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    seeder = multiprocessing.Process(target=serve, args=(server, piece_length), daemon=True)
+    seeder.start()
+    return server.getsockname()[1]
+
+
+def serve(server, piece_length):
+    payload = os.urandom(piece_length)
+
+    def handle(conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with conn:
+            if recv_exact(conn, 68) is None:
+                return
+            conn.sendall(struct.pack('B19s8s20s20s', 19, b'BitTorrent protocol', b'\0' * 8, INFO_HASH, b'S' * 20))
+            conn.sendall(struct.pack('!IB', 1, PeerConnection.UNCHOKE))
+            while True:
+                header = recv_exact(conn, 4)
+                if header is None:
+                    return
+                length = struct.unpack('!I', header)[0]
+                message = recv_exact(conn, length)
+                if message is None:
+                    return
+                if message[0] == PeerConnection.REQUEST:
+                    index, begin, size = struct.unpack('!III', message[1:13])
+                    conn.sendall(struct.pack('!IBII', 9 + size, PeerConnection.PIECE, index, begin) + payload[begin:begin + size])
+
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+def recv_exact(conn, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = conn.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+class LegacyReceiver:
+    """The original blocking receive path, instrumented to count copies"""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.copied = 0
+        self.allocated = 0
+        self.sock.sendall(struct.pack('B19s8s20s20s', 19, b'BitTorrent protocol', b'\0' * 8, INFO_HASH, b'L' * 20))
+        self._recv_exact(68)
+        self._read_message()  # unchoke
+
+    def _recv_exact(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+            self.copied += len(data)
+            self.allocated += len(chunk) + len(data)
+        return data
+
+    def _read_message(self):
+        length = struct.unpack('!I', self._recv_exact(4))[0]
+        data = self._recv_exact(length)
+        payload = data[1:]
+        self.copied += len(payload)
+        self.allocated += len(payload)
+        return data[0], payload
+
+    def download_piece(self, index, piece_length):
+        blocks = {}
+        for begin in range(0, piece_length, BLOCK_SIZE):
+            self.sock.sendall(struct.pack('!IBIII', 13, PeerConnection.REQUEST, index, begin, BLOCK_SIZE))
+        while len(blocks) * BLOCK_SIZE < piece_length:
+            message_id, payload = self._read_message()
+            if message_id == PeerConnection.PIECE:
+                _, begin = struct.unpack('!II', payload[:8])
+                blocks[begin] = payload[8:]
+                self.copied += len(blocks[begin])
+                self.allocated += len(blocks[begin])
+        piece = b''.join(data for _, data in sorted(blocks.items()))
+        self.copied += len(piece)
+        self.allocated += len(piece)
+        return piece
+
+    def run(self, pieces, piece_length):
+        start = time.perf_counter()
+        for index in range(pieces):
+            self.download_piece(index, piece_length)
+        elapsed = time.perf_counter() - start
+        self.sock.close()
+        return elapsed
+
+
+class CountingPeer(PeerConnection):
+    """PeerConnection that counts block bytes copied out of its scratch buffer"""
+
+    copied = 0
+    allocated = 0
+
+    def _start_block(self, piece_index, begin, length):
+        self.copied += min(length, self.recv_end - self.recv_start)
+        super()._start_block(piece_index, begin, length)
+
+
+async def zero_copy_run(port, pieces, piece_length):
+    torrent = SimpleNamespace(info_hash=INFO_HASH, num_pieces=pieces)
+    peer = CountingPeer('127.0.0.1', port, torrent, b'Z' * 20)
+    done = asyncio.get_running_loop().create_future()
+    state = {'index': 0, 'received': 0, 'buffer': bytearray(piece_length)}
+
+    def request_piece():
+        state['buffer'] = bytearray(piece_length)
+        peer.allocated += piece_length
+        state['received'] = 0
+        for begin in range(0, piece_length, BLOCK_SIZE):
+            peer.request_piece(state['index'], begin, BLOCK_SIZE)
+
+    def block_buffer(peer, index, begin, length):
+        return memoryview(state['buffer'])[begin:begin + length]
+
+    def block_received(peer, index, begin, length):
+        state['received'] += length
+        if state['received'] == piece_length:
+            state['index'] += 1
+            if state['index'] == pieces:
+                done.set_result(None)
+            else:
+                request_piece()
+
+    peer.on_block_buffer = block_buffer
+    peer.on_block = block_received
+    await peer.connect()
+    while peer.peer_choking:
+        await asyncio.sleep(0.001)
+    start = time.perf_counter()
+    request_piece()
+    await done
+    elapsed = time.perf_counter() - start
+    peer.close()
+    return peer.copied, peer.allocated, elapsed
+
+
+def measure(label, func, total_bytes):
+    copied, allocated, elapsed = func()
+    print(f"{label:<10} {total_bytes / elapsed / 1e6:9.1f} MB/s  "
+          f"allocated {allocated / total_bytes:5.2f}  copied {copied / total_bytes:5.2f}  (bytes per payload byte)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pieces', type=int, default=256)
+    parser.add_argument('--piece-length', type=int, default=262144)
+    args = parser.parse_args()
+    port = start_seeder(args.piece_length)
+    total = args.pieces * args.piece_length
+
+    def legacy():
+        receiver = LegacyReceiver(port)
+        elapsed = receiver.run(args.pieces, args.piece_length)
+        return receiver.copied, receiver.allocated, elapsed
+
+    def zero_copy():
+        # PeerConnection logs every block, keep that out of the measurement
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return asyncio.run(zero_copy_run(port, args.pieces, args.piece_length))
+
+    print(f"{args.pieces} pieces of {args.piece_length} bytes over loopback")
+    measure('legacy', legacy, total)
+    measure('zero-copy', zero_copy, total)
+
+
+if __name__ == '__main__':
+    main()
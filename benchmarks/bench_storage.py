@@ -0,0 +1,87 @@
+"""Disk write benchmark: original seek/write/flush path against Storage.
+
+Writes the same pieces, in random order as a swarm would deliver them, once
+through the original single-file ``seek``/``write``/``flush`` per piece and
+then through Storage (positional writes across a multi-file layout). The original
+path never fsyncs, so Storage is measured both without fsync and with fsync
+batched every ``--fsync-mb``, which includes its final fsync on close.
+
+    python benchmarks/bench_storage.py [--size-mb 512] [--piece-length 262144] [--files 8]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Storage
+
+
+def legacy_write(path, length, piece_length, order, piece):
+    # the original BitTorrentClient.start / piece_completed file handling
+    output_file = open(path, 'wb')
+    output_file.seek(length - 1)
+    output_file.write(b'\0')
+    output_file.flush()
+    for piece_index in order:
+        output_file.seek(piece_index * piece_length)
+        output_file.write(piece)
+        output_file.flush()
+    output_file.close()
+
+
+def storage_write(directory, length, piece_length, files, order, piece, fsync_bytes):
+    file_length = length // files
+    layout = [(f'file{i}', file_length) for i in range(files)]
+    torrent = SimpleNamespace(files=layout, piece_length=piece_length, length=length)
+    storage = Storage(torrent, directory, fsync_bytes)
+    storage.open()
+    for piece_index in order:
+        storage.write_piece(piece_index, piece)
+    if fsync_bytes == float('inf'):
+        storage.dirty.clear()
+    storage.close()
+
+
+def measure(label, func, length):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {length / elapsed / 1e6:9.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--piece-length', type=int, default=262144)
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--fsync-mb', type=int, default=64)
+    parser.add_argument('--dir', default=None, help='directory to write in (default: a temporary one)')
+    args = parser.parse_args()
+
+    num_pieces = args.size_mb * (1 << 20) // args.piece_length
+    length = num_pieces * args.piece_length
+    order = list(range(num_pieces))
+    random.shuffle(order)
+    piece = os.urandom(args.piece_length)
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        print(f"{num_pieces} pieces of {args.piece_length} bytes in random order")
+        measure('legacy seek/write/flush', lambda: legacy_write(
+            os.path.join(directory, 'legacy.bin'), length, args.piece_length, order, piece), length)
+        measure('storage pwrite, no fsync', lambda: storage_write(
+            os.path.join(directory, 'no-fsync'), length, args.piece_length, args.files, order, piece, float('inf')), length)
+        measure(f'storage pwrite, fsync/{args.fsync_mb}MB', lambda: storage_write(
+            os.path.join(directory, 'fsync'), length, args.piece_length, args.files, order, piece, args.fsync_mb << 20), length)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
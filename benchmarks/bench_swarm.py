@@ -0,0 +1,323 @@
+"""Loopback swarm benchmark: BitTorrentClient downloading from local seeders.
+
+Builds a synthetic torrent (--size-mb of random data cut into
+--piece-length pieces, over --files files) with Bencode.encode, and starts
+--seeders seeders speaking the peer wire protocol on 127.0.0.1. The seeders
+run in a child process so their CPU time is not charged to the client. Every
+seeder answers requests after --latency-ms and sends at most --rate-mb MB/s
+per connection. A local HTTP tracker hands their addresses to the client,
+which then downloads the torrent the same way it would from the internet.
+
+Reported for the client process:
+  mb_per_s            payload bytes over the time until the last piece verified
+  first_piece_s       time from start until the first piece verified
+  cpu_s               user + system CPU time of the download
+  peak_rss_mb         peak resident set size
+  syscalls            socket, file and selector calls made by the client,
+                      counted by wrapping their Python entry points
+
+    python benchmarks/bench_swarm.py [--size-mb 64] [--seeders 4] [--latency-ms 20] [--rate-mb 0] [--json -]
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import resource
+import selectors
+import shutil
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bencode import Bencode
+
+
+def make_torrent(directory, size, piece_length, files, tracker_url):
+    # random payload written in chunks, hashed piece by piece as it goes
+    lengths = [size // files] * files
+    lengths[-1] += size - sum(lengths)
+    names = [f'file{i}.bin' for i in range(files)]
+    os.makedirs(os.path.join(directory, 'payload'))
+    pieces = []
+    piece = hashlib.sha1()
+    piece_fill = 0
+    for name, length in zip(names, lengths):
+        with open(os.path.join(directory, 'payload', name), 'wb') as f:
+            while length:
+                chunk = os.urandom(min(length, piece_length - piece_fill, 1 << 20))
+                f.write(chunk)
+                piece.update(chunk)
+                piece_fill += len(chunk)
+                length -= len(chunk)
+                if piece_fill == piece_length:
+                    pieces.append(piece.digest())
+                    piece, piece_fill = hashlib.sha1(), 0
+    if piece_fill:
+        pieces.append(piece.digest())
+
+    info = {'name': 'payload', 'piece length': piece_length, 'pieces': b''.join(pieces)}
+    if files == 1:
+        info['name'] = names[0]
+        os.rename(os.path.join(directory, 'payload', names[0]), os.path.join(directory, names[0]))
+        os.rmdir(os.path.join(directory, 'payload'))
+        info['length'] = size
+    else:
+        info['files'] = [{'length': length, 'path': [name]} for name, length in zip(names, lengths)]
+    path = os.path.join(directory, 'bench.torrent')
+    with open(path, 'wb') as f:
+        f.write(Bencode.encode({'announce': tracker_url, 'info': info}))
+    return path, hashlib.sha1(Bencode.encode(info)).digest(), [os.path.join(*(['payload'] if files > 1 else []), name) for name in names]
+
+
+class Seeder:
+    """One seeding connection: requests are answered in order, each no
+    sooner than latency after it arrived and no faster than rate bytes/s"""
+
+    def __init__(self, reader, writer, payload, info_hash, num_pieces, piece_length, latency, rate):
+        self.reader = reader
+        self.writer = writer
+        self.payload = payload
+        self.info_hash = info_hash
+        self.num_pieces = num_pieces
+        self.piece_length = piece_length
+        self.latency = latency
+        self.rate = rate
+        self.requests = deque()
+        self.wakeup = asyncio.Event()
+
+    async def run(self):
+        handshake = await self.reader.readexactly(68)
+        if handshake[28:48] != self.info_hash:
+            self.writer.close()
+            return
+        self.writer.write(struct.pack('B19s8s20s20s', 19, b'BitTorrent protocol', bytes(8), self.info_hash,
+                                      b'-BS0001-' + os.urandom(12)))
+        bitfield = bytearray(b'\xff' * ((self.num_pieces + 7) // 8))
+        if self.num_pieces % 8:
+            bitfield[-1] = (0xff << (8 - self.num_pieces % 8)) & 0xff
+        self.writer.write(struct.pack('!IB', len(bitfield) + 1, 5) + bitfield)
+        self.writer.write(struct.pack('!IB', 1, 1)) # unchoke
+        sender = asyncio.ensure_future(self.send_loop())
+        try:
+            while True:
+                length = struct.unpack('!I', await self.reader.readexactly(4))[0]
+                if not length:
+                    continue
+                message = await self.reader.readexactly(length)
+                if message[0] == 6:
+                    self.requests.append((asyncio.get_running_loop().time() + self.latency, message[1:13]))
+                    self.wakeup.set()
+                elif message[0] == 8:
+                    for position, (_, request) in enumerate(self.requests):
+                        if request == message[1:13]:
+                            del self.requests[position]
+                            break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            sender.cancel()
+            self.writer.close()
+
+    async def send_loop(self):
+        loop = asyncio.get_running_loop()
+        next_send = loop.time()
+        while True:
+            if not self.requests:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            due, request = self.requests[0]
+            start = max(due, next_send)
+            if start > loop.time():
+                await asyncio.sleep(start - loop.time())
+                continue # the request may have been cancelled meanwhile
+            self.requests.popleft()
+            index, begin, length = struct.unpack('!III', request)
+            offset = index * self.piece_length + begin
+            self.writer.write(struct.pack('!IBII', 9 + length, 7, index, begin) + self.payload[offset:offset + length])
+            if self.rate:
+                next_send = max(next_send, loop.time() - 0.1) + length / self.rate
+            await self.writer.drain()
+
+
+def run_seeders(directory, files, info_hash, piece_length, seeders, latency, rate, ports_pipe):
+    # child process: every seeder serves the concatenated payload from memory
+    payload = b''.join(open(os.path.join(directory, name), 'rb').read() for name in files)
+    num_pieces = (len(payload) + piece_length - 1) // piece_length
+
+    async def main():
+        servers = []
+        for _ in range(seeders):
+            server = await asyncio.start_server(
+                lambda r, w: Seeder(r, w, payload, info_hash, num_pieces, piece_length, latency, rate).run(),
+                '127.0.0.1', 0)
+            servers.append(server)
+        ports_pipe.send([server.sockets[0].getsockname()[1] for server in servers])
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def start_tracker(ports):
+    # ports is read on every announce, the seeders' are added once they listen
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            peers = b''.join(socket.inet_aton('127.0.0.1') + struct.pack('>H', port) for port in ports)
+            body = Bencode.encode({'interval': 1800, 'peers': peers})
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def count_syscalls():
+    """Wrap the socket, file and selector calls the client makes, return the counter"""
+    counts = Counter()
+
+    def wrap(owner, name, label):
+        original = getattr(owner, name, None)
+        if original is None:
+            return
+        def counted(*args, **kwargs):
+            counts[label] += 1
+            return original(*args, **kwargs)
+        setattr(owner, name, counted)
+
+    for name in ('recv', 'recv_into', 'send', 'sendmsg', 'sendall'):
+        wrap(socket.socket, name, name)
+    for name in ('pwrite', 'pwritev', 'pread', 'preadv', 'fsync', 'sendfile', 'read', 'write'):
+        wrap(os, name, name)
+    selector = type(selectors.DefaultSelector())
+    wrap(selector, 'select', 'select')
+    return counts
+
+
+def rss_mb(maxrss):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return maxrss / (1 << 20) if sys.platform == 'darwin' else maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--piece-length', type=int, default=262144)
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--seeders', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=0, help='delay before each request is answered')
+    parser.add_argument('--rate-mb', type=float, default=0, help='upload cap of every seeder connection, 0 for none')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--json', metavar='PATH', help="write the results as JSON to PATH, '-' for stdout")
+    parser.add_argument('--verbose', action='store_true', help="show the client's own output")
+    parser.add_argument('--dir', default=None, help='directory to work in (default: a temporary one)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    seeders = None
+    tracker = None
+    try:
+        size = args.size_mb << 20
+        ports = []
+        tracker = start_tracker(ports)
+        tracker_url = f'http://127.0.0.1:{tracker.server_address[1]}/announce'
+        seed_dir = os.path.join(directory, 'seed')
+        os.makedirs(seed_dir)
+        torrent_path, info_hash, files = make_torrent(seed_dir, size, args.piece_length, args.files, tracker_url)
+
+        receive, send = multiprocessing.Pipe(duplex=False)
+        seeders = multiprocessing.Process(target=run_seeders, daemon=True, args=(
+            seed_dir, files, info_hash, args.piece_length, args.seeders, args.latency_ms / 1000, args.rate_mb * 1e6, send))
+        seeders.start()
+        ports.extend(receive.recv())
+
+        from client import BitTorrentClient
+        from listener import PeerListener
+
+        download_dir = os.path.join(directory, 'download')
+        os.makedirs(download_dir)
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            client = BitTorrentClient(torrent_path, download_dir=download_dir, listener=PeerListener(0))
+            verified = []
+            piece_completed = client.piece_completed
+            def timed_piece_completed(piece_index, piece_data):
+                verified.append(time.perf_counter())
+                piece_completed(piece_index, piece_data)
+            client.piece_completed = timed_piece_completed
+
+            counts = count_syscalls()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            start = time.perf_counter()
+            client.start()
+            while not client.is_seeding() and time.perf_counter() - start < args.timeout:
+                time.sleep(0.05)
+            finished = client.is_seeding()
+            end = verified[-1] if finished else time.perf_counter()
+            client.stop()
+            end_usage = resource.getrusage(resource.RUSAGE_SELF)
+            syscalls = dict(counts)
+
+        matches = finished and all(
+            open(os.path.join(seed_dir, name), 'rb').read() == open(os.path.join(download_dir, name), 'rb').read()
+            for name in files)
+        elapsed = end - start
+        results = {
+            'size_mb': args.size_mb,
+            'piece_length': args.piece_length,
+            'files': args.files,
+            'seeders': args.seeders,
+            'latency_ms': args.latency_ms,
+            'rate_mb': args.rate_mb,
+            'completed': finished,
+            'verified': matches,
+            'seconds': round(elapsed, 3),
+            'mb_per_s': round(size / elapsed / 1e6, 2),
+            'first_piece_s': round(verified[0] - start, 4) if verified else None,
+            'cpu_s': round(end_usage.ru_utime - usage.ru_utime + end_usage.ru_stime - usage.ru_stime, 3),
+            'peak_rss_mb': round(rss_mb(end_usage.ru_maxrss), 1),
+            'syscalls': sum(syscalls.values()),
+            'syscalls_per_mb': round(sum(syscalls.values()) / args.size_mb, 1),
+            'syscalls_by_call': syscalls,
+        }
+        if args.json:
+            text = json.dumps(results, indent=2)
+            if args.json == '-':
+                print(text)
+            else:
+                with open(args.json, 'w') as f:
+                    f.write(text + '\n')
+        if args.json != '-':
+            for key, value in results.items():
+                if key != 'syscalls_by_call':
+                    print(f"{key:<16} {value}")
+        if not matches:
+            sys.exit(1)
+    finally:
+        if seeders is not None:
+            seeders.terminate()
+        if tracker is not None:
+            tracker.shutdown()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
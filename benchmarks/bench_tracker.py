@@ -0,0 +1,125 @@
+"""HTTP tracker benchmark: compact peer parsing and repeated announces.
+
+Parses a compact response with --peers IPv4 and as many IPv6 peers through a
+copy of the original per-peer loop (which skips peers6) and through
+parse_compact_peers. It then announces --announces times to a local
+keep-alive tracker serving the IPv4 peers, once with a new urllib connection per
+announce as before and once through TrackerClient's HTTP session. The tracker
+runs in this process, so the client's own cost is reported as the CPU time of
+the announcing thread.
+
+    python benchmarks/bench_tracker.py [--peers 10000] [--announces 50]
+"""
+import argparse
+import http.server
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import urllib.request
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bencode import Bencode
+from tracker import TrackerClient, parse_compact_peers
+
+
+def legacy_parse_peers(peers_data):
+    # the original compact peer loop
+    peers = []
+    for i in range(0, len(peers_data), 6):
+        ip_bytes = peers_data[i:i+4]
+        port_bytes = peers_data[i+4:i+6]
+        ip = '.'.join(str(b) for b in ip_bytes)
+        port = struct.unpack('>H', port_bytes)[0]
+        peers.append((ip, port))
+    return peers
+
+
+def start_tracker(body):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body go out in separate writes, don't let Nagle hold the body
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def best_of(func, repeat = 5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--peers', type=int, default=10000)
+    parser.add_argument('--announces', type=int, default=50)
+    args = parser.parse_args()
+
+    peers = os.urandom(6 * args.peers)
+    peers6 = os.urandom(18 * args.peers)
+
+    print(f"parsing {args.peers} compact peers")
+    for label, func in (('legacy IPv4', lambda: legacy_parse_peers(peers)),
+                        ('parse_compact_peers IPv4', lambda: parse_compact_peers(peers)),
+                        ('parse_compact_peers IPv6', lambda: parse_compact_peers(peers6, ipv6=True))):
+        elapsed = best_of(func)
+        print(f"  {label:<26} {elapsed * 1000:8.2f} ms")
+
+    port = start_tracker(Bencode.encode({'interval': 1800, 'peers': peers}))
+    url = f'http://127.0.0.1:{port}/announce'
+    torrent = SimpleNamespace(info_hash=b'\x11' * 20, length=1 << 30, announce_list=[[url]])
+    client = TrackerClient(torrent)
+    tracker = client.tiers[0][0]
+    query = '?info_hash=%11%11%11%11%11%11%11%11%11%11%11%11%11%11%11%11%11%11%11%11&compact=1'
+
+    def legacy_announces():
+        for _ in range(args.announces):
+            response = urllib.request.urlopen(urllib.request.Request(url + query), timeout=30)
+            legacy_parse_peers(Bencode.decode(response.read())['peers'])
+
+    def session_announces():
+        for _ in range(args.announces):
+            response = client._announce_http(tracker, 0, 0, 1 << 30, '', 30)
+            parse_compact_peers(response['peers'])
+
+    connections = []
+    original_create_connection = socket.create_connection
+    def counting_create_connection(*a, **kw):
+        connections.append(a[0])
+        return original_create_connection(*a, **kw)
+    socket.create_connection = counting_create_connection
+
+    print(f"{args.announces} announces to a local tracker returning those peers")
+    for label, func in (('urllib per announce', legacy_announces), ('keep-alive session', session_announces)):
+        connections.clear()
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        func()
+        elapsed, cpu = time.perf_counter() - start, time.thread_time() - cpu_start
+        print(f"  {label:<26} {elapsed / args.announces * 1000:8.2f} ms per announce, "
+              f"{cpu / args.announces * 1000:6.2f} ms client CPU, {len(connections)} TCP connections")
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
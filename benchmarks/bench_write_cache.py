@@ -0,0 +1,133 @@
+"""Write-back cache benchmark: one write per piece against batched pwritev.
+
+Writes the same pieces three ways: the original seek/write/flush per piece,
+one Storage.write_piece per piece on a disk thread (the path before the
+write cache), and through WriteCache, which coalesces runs of consecutive
+pieces into one pwritev per file. Pieces arrive in a given order, either
+sequential (streaming, or a swarm of fast seeders) or random (rarest first).
+Runs end without fsync unless --fsync is given, so the page cache absorbs the
+writes and the cost of the write path itself is measured. Dirty pages are
+synced between runs. Write syscalls come from /proc/self/io, so they are
+only reported on Linux.
+
+    python benchmarks/bench_write_cache.py [--size-mb 256] [--piece-length 16384] [--order sequential] [--fsync]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Storage
+from write_cache import WriteCache
+
+
+def write_syscalls():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('syscw:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def legacy_write(directory, torrent, order, piece, fsync):
+    # the original BitTorrentClient.start / piece_completed file handling
+    output_file = open(os.path.join(directory, 'legacy.bin'), 'wb')
+    output_file.seek(torrent.length - 1)
+    output_file.write(b'\0')
+    output_file.flush()
+    for piece_index in order:
+        output_file.seek(piece_index * torrent.piece_length)
+        output_file.write(piece)
+        output_file.flush()
+    if fsync:
+        os.fsync(output_file.fileno())
+    output_file.close()
+
+
+def open_storage(directory, torrent, fsync):
+    storage = Storage(torrent, directory, fsync_bytes=float('inf'))
+    storage.open()
+    if not fsync:
+        storage.sync = storage.dirty.clear
+    return storage
+
+
+def per_piece_write(directory, torrent, order, piece, fsync):
+    # one positional write per piece, submitted to the disk thread as it completes
+    storage = open_storage(os.path.join(directory, 'per-piece'), torrent, fsync)
+    with ThreadPoolExecutor(max_workers=1) as disk_writer:
+        for piece_index in order:
+            disk_writer.submit(storage.write_piece, piece_index, piece)
+    storage.close()
+
+
+def cached_write(directory, torrent, order, piece, cache_mb, fsync):
+    storage = open_storage(os.path.join(directory, 'cached'), torrent, fsync)
+    with ThreadPoolExecutor(max_workers=1) as disk_writer:
+        cache = WriteCache(storage, disk_writer, max_bytes=cache_mb << 20)
+        for piece_index in order:
+            cache.add(piece_index, piece)
+        cache.close()
+    storage.close()
+
+
+def measure(label, func, length):
+    if hasattr(os, 'sync'):
+        os.sync()
+    syscalls = write_syscalls()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    line = f"{label:<28} {length / elapsed / 1e6:9.1f} MB/s"
+    if syscalls is not None:
+        per_gb = (write_syscalls() - syscalls) * (1 << 30) / length
+        line += f" {per_gb:12.0f} write syscalls/GB"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--piece-length', type=int, default=16384)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--order', choices=('sequential', 'random'), default='sequential')
+    parser.add_argument('--cache-mb', type=int, default=32)
+    parser.add_argument('--fsync', action='store_true', help='fsync at the end of every run')
+    parser.add_argument('--dir', default=None, help='directory to write in (default: a temporary one)')
+    args = parser.parse_args()
+
+    num_pieces = args.size_mb * (1 << 20) // args.piece_length
+    length = num_pieces * args.piece_length
+    file_length = length // args.files
+    torrent = SimpleNamespace(files=[(f'file{i}', file_length) for i in range(args.files)],
+                              piece_length=args.piece_length, length=length)
+    order = list(range(num_pieces))
+    if args.order == 'random':
+        random.shuffle(order)
+    piece = os.urandom(args.piece_length)
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        print(f"{num_pieces} pieces of {args.piece_length} bytes in {args.order} order")
+        measure('legacy seek/write/flush', lambda: legacy_write(
+            directory, torrent, order, piece, args.fsync), length)
+        measure('pwrite per piece', lambda: per_piece_write(
+            directory, torrent, order, piece, args.fsync), length)
+        measure(f'write cache ({args.cache_mb} MB)', lambda: cached_write(
+            directory, torrent, order, piece, args.cache_mb, args.fsync), length)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
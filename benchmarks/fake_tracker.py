@@ -0,0 +1,249 @@
+"""Fake UDP and HTTP trackers and checks of the tracker clients against them.
+
+The UDP tracker speaks BEP 15 and can drop a number of packets, forget the
+connection ids it handed out or answer every announce with an error. The
+HTTP tracker answers with a fixed status and bencoded body. Both run in this
+process on 127.0.0.1; the checks cover UDP retransmits, connection id expiry
+on either side, tracker errors, a tracker that never answers, a malformed
+URL in the announce list, a dead tier not holding back the peers of a
+live one and a 'stopped' announce giving up after STOP_TIMEOUT. Timeouts
+are scaled down so the whole run takes a few seconds.
+
+    python benchmarks/fake_tracker.py
+"""
+import http.server
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bencode import Bencode
+from tracker import TrackerClient, parse_compact_peers
+from udp_tracker import TrackerError, UDPTracker
+
+PEERS = [('10.0.0.1', 6881), ('10.0.0.2', 6882)]
+COMPACT_PEERS = b''.join(socket.inet_aton(ip) + struct.pack('>H', port) for ip, port in PEERS)
+INFO_HASH = b'\x11' * 20
+
+
+class FakeUDPTracker:
+    """BEP 15 tracker on a thread of its own.
+
+    drop packets are ignored before it starts answering, silent ones are all
+    ignored, error makes every announce fail with that message. connects
+    and announces count the requests it answered.
+    """
+
+    def __init__(self, drop = 0, silent = False, error = None):
+        self.drop = drop
+        self.silent = silent
+        self.error = error
+        self.connects = 0
+        self.announces = 0
+        self.connection_ids = set()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.url = f'udp://127.0.0.1:{self.sock.getsockname()[1]}/announce'
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def expire(self):
+        # forget every connection id handed out so far
+        self.connection_ids.clear()
+
+    def _serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except OSError:
+                return
+            if self.silent or self.drop > 0:
+                self.drop -= 1
+                continue
+            reply = self._handle(data)
+            if reply is not None:
+                self.sock.sendto(reply, address)
+
+    def _handle(self, data):
+        if len(data) < 16:
+            return None
+        connection_id, action, transaction_id = struct.unpack_from('>QII', data)
+        if action == UDPTracker.CONNECT:
+            if connection_id != UDPTracker.PROTOCOL_ID:
+                return None
+            self.connects += 1
+            connection_id = int.from_bytes(os.urandom(8), 'big')
+            self.connection_ids.add(connection_id)
+            return struct.pack('>IIQ', UDPTracker.CONNECT, transaction_id, connection_id)
+        if connection_id not in self.connection_ids:
+            return struct.pack('>II', UDPTracker.ERROR, transaction_id) + b'unknown connection id'
+        if action == UDPTracker.ANNOUNCE:
+            if self.error:
+                return struct.pack('>II', UDPTracker.ERROR, transaction_id) + self.error.encode()
+            self.announces += 1
+            return struct.pack('>IIIII', UDPTracker.ANNOUNCE, transaction_id, 1800, 1, 1) + COMPACT_PEERS
+        return None
+
+    def close(self):
+        self.sock.close()
+
+
+def start_http_tracker(status, body):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}/announce'
+
+
+def udp_announce(client, max_retries = None):
+    response = client.announce(INFO_HASH, b'-PC0001-' + b'\x00' * 12, 6881, 0, 0, 1 << 30, 'started',
+                               max_retries=max_retries)
+    return parse_compact_peers(response['peers'])
+
+
+def expect_error(func, text):
+    try:
+        func()
+    except TrackerError as e:
+        assert text in str(e), f"expected {text!r} in {e!r}"
+        return str(e)
+    raise AssertionError(f"expected a TrackerError containing {text!r}")
+
+
+def check_retransmit():
+    # the first connect request is lost and resent after base_timeout
+    tracker = FakeUDPTracker(drop=1)
+    client = UDPTracker(tracker.url, base_timeout=0.1, max_retries=3)
+    assert udp_announce(client) == PEERS
+    tracker.drop = 1
+    client.connection_id = None
+    start = time.monotonic()
+    assert udp_announce(client) == PEERS
+    elapsed = time.monotonic() - start
+    assert elapsed >= 0.1, elapsed
+    client.close()
+    tracker.close()
+    return f"answered after retransmits, {elapsed * 1000:.0f} ms for one lost packet"
+
+
+def check_connection_id_expiry():
+    tracker = FakeUDPTracker()
+    client = UDPTracker(tracker.url, base_timeout=0.2, max_retries=1)
+    client.CONNECTION_ID_TTL = 0.2
+    udp_announce(client)
+    udp_announce(client)
+    assert tracker.connects == 1, tracker.connects
+    # our side: the cached id is too old and a new one is asked for
+    time.sleep(0.3)
+    udp_announce(client)
+    assert tracker.connects == 2, tracker.connects
+    # the tracker's side: it forgot the id, the announce fails and the next
+    # one reconnects
+    tracker.expire()
+    expect_error(lambda: udp_announce(client), 'unknown connection id')
+    assert client.connection_id is None
+    assert udp_announce(client) == PEERS
+    assert tracker.connects == 3, tracker.connects
+    client.close()
+    tracker.close()
+    return "reconnected after both local and tracker side expiry"
+
+
+def check_errors():
+    tracker = FakeUDPTracker(error='torrent not registered')
+    client = UDPTracker(tracker.url, base_timeout=0.2, max_retries=1)
+    message = expect_error(lambda: udp_announce(client), 'torrent not registered')
+    client.close()
+    tracker.close()
+
+    silent = FakeUDPTracker(silent=True)
+    client = UDPTracker(silent.url, base_timeout=0.05, max_retries=2)
+    start = time.monotonic()
+    expect_error(lambda: udp_announce(client), 'no response')
+    elapsed = time.monotonic() - start
+    # 0.05 + 0.1 + 0.2 seconds of retransmit timeouts
+    assert 0.3 <= elapsed < 1, elapsed
+    client.close()
+    silent.close()
+
+    expect_error(lambda: UDPTracker('udp://127.0.0.1/announce'), 'invalid UDP tracker URL')
+
+    torrent = SimpleNamespace(info_hash=INFO_HASH, length=1 << 30)
+    for status, body, text in ((200, Bencode.encode({'failure reason': 'banned client'}), 'banned client'),
+                               (500, b'oops', 'HTTP 500'),
+                               (200, Bencode.encode({'interval': 1800}), "missing 'peers'")):
+        torrent.announce_list = [[start_http_tracker(status, body)]]
+        client = TrackerClient(torrent)
+        expect_error(lambda: client._announce_http(client.tiers[0][0], 0, 0, 1 << 30, '', 5), text)
+        client.close()
+    return f"UDP error {message!r}, silent tracker gave up after {elapsed * 1000:.0f} ms, HTTP errors raised"
+
+
+def check_tiers():
+    dead = FakeUDPTracker(silent=True)
+    live = start_http_tracker(200, Bencode.encode({'interval': 1800, 'peers': COMPACT_PEERS}))
+    # a port-less UDP URL is skipped instead of failing the whole client
+    torrent = SimpleNamespace(info_hash=INFO_HASH, length=1 << 30,
+                              announce_list=[['udp://127.0.0.1/announce', dead.url], [live]])
+    client = TrackerClient(torrent)
+    assert [len(tier) for tier in client.tiers] == [1, 1], client.tiers
+    client.tiers[0][0].udp.base_timeout = 0.5
+    client.tiers[0][0].udp.max_retries = 1
+
+    start = time.monotonic()
+    delivered = []
+    peers, _ = client.announce(on_peers=lambda tier_peers: delivered.append((time.monotonic() - start, tier_peers)))
+    elapsed = time.monotonic() - start
+    assert peers == PEERS, peers
+    assert [tier_peers for _, tier_peers in delivered] == [PEERS], delivered
+    # the live tier's peers arrive long before the dead tier gives up
+    assert delivered[0][0] < 0.5 < elapsed, (delivered, elapsed)
+    client.close()
+    dead.close()
+    return f"live tier's peers after {delivered[0][0] * 1000:.0f} ms, dead tier gave up after {elapsed * 1000:.0f} ms"
+
+
+def check_stop():
+    # 'stopped' to a silent UDP tracker gives up after STOP_TIMEOUT, although
+    # a single retransmit interval is far longer and a connect is due first
+    dead = FakeUDPTracker(silent=True)
+    torrent = SimpleNamespace(info_hash=INFO_HASH, length=1 << 30, announce_list=[[dead.url]])
+    client = TrackerClient(torrent)
+    client.STOP_TIMEOUT = 0.3
+    tracker = client.tiers[0][0]
+    tracker.started = True
+    start = time.monotonic()
+    client.announce(event='stopped')
+    elapsed = time.monotonic() - start
+    assert tracker.udp.base_timeout == TrackerClient.UDP_TIMEOUT
+    assert 0.3 <= elapsed < 1, elapsed
+    client.close()
+    dead.close()
+    return f"stopped announce gave up after {elapsed * 1000:.0f} ms"
+
+
+def main():
+    for check in (check_retransmit, check_connection_id_expiry, check_errors, check_tiers, check_stop):
+        print(f"{check.__name__:<28} ok: {check()}")
+
+
+if __name__ == '__main__':
+    main()
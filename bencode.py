@@ -1,38 +1,111 @@
+import re
+
+
 class Bencode: 
+    # string length prefixes and integers, matched in place so the
+    # input can be any buffer, memoryviews included
+    STRING = re.compile(rb'(\d+):')
+    INTEGER = re.compile(rb'i(-?\d+)e')
+
+    # lazy decoding only returns views for strings at least this long, a
+    # memoryview object costs more than copying a short string
+    LAZY_MIN = 256
+
+    @staticmethod
+    def decode(data, lazy = False):
+        """Decode one bencoded value from data (bytes, bytearray or memoryview).
+
+        With lazy=True long string values such as ``pieces`` are returned as
+        memoryview slices of data instead of copies; they keep the whole
+        buffer alive. Dict keys are str, or bytes when they are not UTF-8.
+        """
+        return Bencode.decode_spans(data, (), lazy)[0]
+
     @staticmethod
-    def decode(data):
-        def decode_next(data, index): 
-            if data[index: index + 1] == b'i':
-                end = data.find(b'e', index)
-                if end == -1:
-                    raise ValueError(f"invalid integer at index {index}")
-                return int(data[index+1:end]), end + 1
-            elif data[index:index+1] == b'l': 
-                result = [] 
-                index += 1 
-                while data[index:index + 1] != b'e': 
-                    item, index = decode_next(data, index)
-                    result.append(item)
-                return result, index + 1 
-            elif data[index:index+1] == b'd':
-                result = {}
-                index += 1 
-                while data[index:index+1] != b'e': 
-                    key, index = decode_next(data, index)
-                    value, index = decode_next(data, index)
-                    result[key.decode()] = value
-                return result, index + 1 
-            elif data[index:index+1].isdigit(): 
-                colon = data.find(b':', index)
-                if colon == -1:
-                    raise ValueError(f"invalid string at index {index}")
-                length = int(data[index:colon])
-                return data[colon + 1: colon + 1 + length], colon + 1 + length
-            else: 
-                raise ValueError(f"invalid bencode at index {index}")
-        result, _ = decode_next(data, 0)
-        return result
-    
+    def decode_spans(data, keys = ('info',), lazy = False):
+        """Decode like decode() and also return the raw (start, end) byte span
+        of each top-level dict value whose key is in keys, e.g. the info dict
+        whose SHA-1 is the torrent's info hash"""
+        view = memoryview(data)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        # bytes and bytearray are indexed and sliced directly, other buffers
+        # through the view; copies are always returned as bytes
+        buf = data if isinstance(data, (bytes, bytearray)) else view
+        copy = type(buf) is not bytes
+        lazy_min = Bencode.LAZY_MIN if lazy else len(view) + 1
+        match_string = Bencode.STRING.match
+        match_integer = Bencode.INTEGER.match
+        spans = {}
+
+        # containers being filled, their start offsets and, for dicts, the key
+        # waiting for its value (None while a key is expected)
+        stack = []
+        starts = []
+        pending = []
+        index = 0
+        try:
+            while True:
+                start = index
+                token = buf[index]
+                if 48 <= token <= 57:
+                    number = match_string(buf, index)
+                    if number is None:
+                        raise ValueError(f"invalid string at index {index}")
+                    begin = number.end()
+                    index = begin + int(number.group(1))
+                    if index > len(view):
+                        raise ValueError(f"string at index {start} runs past the end of the data")
+                    if index - begin >= lazy_min:
+                        value = view[begin:index]
+                    elif copy:
+                        value = bytes(view[begin:index])
+                    else:
+                        value = buf[begin:index]
+                elif token == 105:
+                    number = match_integer(buf, index)
+                    if number is None:
+                        raise ValueError(f"invalid integer at index {index}")
+                    value = int(number.group(1))
+                    index = number.end()
+                elif token == 108 or token == 100:
+                    stack.append([] if token == 108 else {})
+                    starts.append(index)
+                    pending.append(None)
+                    index += 1
+                    continue
+                elif token == 101 and stack and pending[-1] is None:
+                    value = stack.pop()
+                    start = starts.pop()
+                    pending.pop()
+                    index += 1
+                else:
+                    raise ValueError(f"invalid bencode at index {index}")
+
+                if not stack:
+                    return value, spans
+                container = stack[-1]
+                if type(container) is list:
+                    container.append(value)
+                elif pending[-1] is None:
+                    if type(value) is memoryview:
+                        value = bytes(value)
+                    try:
+                        pending[-1] = value.decode()
+                    except UnicodeDecodeError:
+                        # binary keys, e.g. the info hashes of a scrape response
+                        pending[-1] = value
+                    except AttributeError:
+                        raise ValueError(f"dict key at index {start} is not a string") from None
+                else:
+                    key = pending[-1]
+                    container[key] = value
+                    pending[-1] = None
+                    if key in keys and len(stack) == 1:
+                        spans[key] = (start, index)
+        except IndexError:
+            raise ValueError(f"bencoded data ends at index {index} before the value does") from None
+
     @staticmethod
     def encode(obj): 
         if isinstance(obj, int): 
@@ -0,0 +1,99 @@
+# offsets of the set bits of every byte value, high bit first as on the wire
+_BITS = [tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256)]
+
+
+class Bitfield:
+    """Set of piece indexes kept as a bitmap in BITFIELD message layout.
+
+    Membership is a byte lookup and a mask, and the population count is kept
+    up to date on every change. A bitfield from the wire is taken in with one
+    copy instead of one set insert per piece, and whole-set operations work
+    on the bitmap as a single int.
+    """
+
+    __slots__ = ('length', 'bits', 'count')
+
+    def __init__(self, length, pieces = ()):
+        self.length = length
+        self.bits = bytearray((length + 7) // 8)
+        self.count = 0
+        for piece_index in pieces:
+            self.add(piece_index)
+
+    @classmethod
+    def from_bytes(cls, data, length):
+        """Bitfield of length pieces from a BITFIELD payload or a saved bitmap,
+        bits past length are dropped"""
+        bitfield = cls(length)
+        data = bytes(data[:len(bitfield.bits)])
+        bitfield.bits[:len(data)] = data
+        if length % 8 and bitfield.bits:
+            bitfield.bits[-1] &= (0xff << (8 - length % 8)) & 0xff
+        bitfield.count = bitfield.popcount()
+        return bitfield
+
+    def _from_int(self, value):
+        bitfield = Bitfield(self.length)
+        bitfield.bits[:] = value.to_bytes(len(self.bits), 'big')
+        bitfield.count = value.bit_count()
+        return bitfield
+
+    def __contains__(self, piece_index):
+        if not 0 <= piece_index < self.length:
+            return False
+        return bool(self.bits[piece_index >> 3] & (0x80 >> (piece_index & 7)))
+
+    has = __contains__
+
+    def add(self, piece_index):
+        """Set a bit, False if it already was"""
+        mask = 0x80 >> (piece_index & 7)
+        byte = self.bits[piece_index >> 3]
+        if byte & mask:
+            return False
+        self.bits[piece_index >> 3] = byte | mask
+        self.count += 1
+        return True
+
+    def discard(self, piece_index):
+        mask = 0x80 >> (piece_index & 7)
+        byte = self.bits[piece_index >> 3]
+        if byte & mask:
+            self.bits[piece_index >> 3] = byte & ~mask
+            self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+    def popcount(self):
+        # counted from the bitmap, len() returns the tracked count
+        return int.from_bytes(self.bits, 'big').bit_count()
+
+    def all(self):
+        return self.count == self.length
+
+    def __iter__(self):
+        # set bits in increasing order, whole zero bytes are skipped
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                base = byte_index << 3
+                for bit in _BITS[byte]:
+                    yield base + bit
+
+    def difference(self, other):
+        """Pieces set here and not in other, e.g. the ones a peer has that we need"""
+        return self._from_int(int.from_bytes(self.bits, 'big') & ~int.from_bytes(other.bits, 'big'))
+
+    __sub__ = difference
+
+    def intersection(self, other):
+        """Pieces set both here and in other"""
+        return self._from_int(int.from_bytes(self.bits, 'big') & int.from_bytes(other.bits, 'big'))
+
+    __and__ = intersection
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+    def __repr__(self):
+        return f"Bitfield({self.count}/{self.length})"
@@ -0,0 +1,91 @@
+import random
+import time
+from collections import deque
+
+
+class Choker:
+    """Tit-for-tat choking: every round the interested peers that send us the
+    most (or, once seeding, that we send the most to) get the upload slots,
+    plus one optimistic unchoke that rotates between the others"""
+
+    INTERVAL = 10 # seconds between rounds
+    OPTIMISTIC_ROUNDS = 3 # the optimistic unchoke moves on every 30 seconds
+    WINDOW = 20 # seconds of transfer history rates are measured over
+
+    def __init__(self, upload_slots = 4):
+        self.upload_slots = upload_slots
+        # peer -> samples of (time, bytes downloaded, bytes uploaded)
+        self.history = {}
+        self.optimistic = None
+        self.rounds = 0
+        self.last_round = None
+
+    def _sample(self, peer, now):
+        history = self.history.get(peer)
+        if history is None:
+            history = self.history[peer] = deque()
+        history.append((now, peer.downloaded, peer.uploaded))
+        # keep one sample at least WINDOW old so rates cover the full window
+        while len(history) > 2 and now - history[1][0] >= self.WINDOW:
+            history.popleft()
+
+    def rates(self, peer):
+        """Download and upload rate of a peer over the sliding window"""
+        history = self.history.get(peer)
+        if not history or len(history) < 2:
+            return 0.0, 0.0
+        start, downloaded, uploaded = history[0]
+        end, last_downloaded, last_uploaded = history[-1]
+        elapsed = end - start
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (last_downloaded - downloaded) / elapsed, (last_uploaded - uploaded) / elapsed
+
+    def remove_peer(self, peer):
+        self.history.pop(peer, None)
+        if self.optimistic is peer:
+            self.optimistic = None
+
+    def tick(self, peers, seeding, now = None):
+        """Sample transfer counters, running a choke round every INTERVAL"""
+        now = now or time.monotonic()
+        for peer in peers:
+            self._sample(peer, now)
+        if self.last_round is None or now - self.last_round >= self.INTERVAL:
+            self.last_round = now
+            self.rechoke(peers, seeding)
+        else:
+            self.fill(peers)
+
+    def rechoke(self, peers, seeding):
+        self.rounds += 1
+        interested = [peer for peer in peers if peer.peer_interested and peer.connected]
+        # reciprocate while downloading, favour fast downloaders once seeding
+        rate = 1 if seeding else 0
+        interested.sort(key=lambda peer: self.rates(peer)[rate], reverse=True)
+        regular = interested[:max(self.upload_slots - 1, 0)]
+
+        candidates = interested[len(regular):]
+        if self.optimistic not in candidates or self.rounds % self.OPTIMISTIC_ROUNDS == 0:
+            self.optimistic = random.choice(candidates) if candidates else None
+        unchoke = set(regular)
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        for peer in peers:
+            if peer in unchoke:
+                if peer.am_chocking:
+                    peer.send_unchoke()
+            elif not peer.am_chocking:
+                peer.send_choke()
+
+    def fill(self, peers):
+        # between rounds, slots freed by peers that left or lost interest go
+        # to interested peers that are waiting
+        unchoked = sum(1 for peer in peers if not peer.am_chocking and peer.peer_interested and peer.connected)
+        for peer in peers:
+            if unchoked >= self.upload_slots:
+                break
+            if peer.am_chocking and peer.peer_interested and peer.connected:
+                peer.send_unchoke()
+                unchoked += 1
@@ -1,26 +1,109 @@
-import time 
-import threading 
+import asyncio
+import functools
 import hashlib
+import logging
+import math
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bitfield import Bitfield
+from choker import Choker
+from engine import PeerEngine
+from hasher import HashPool
+from listener import PeerListener
+from metrics import REGISTRY
 from torrent import TorrentFile
 from tracker import TrackerClient
-from peer import PeerConnection
+from peer import PeerConnection, allowed_fast_set
+from peer_manager import PeerManager
+from picker import PiecePicker
+from piece_state import PieceState
+from ratelimit import RateLimiter
+from resume import ResumeData, recheck
+from storage import Storage
+from stream import TorrentStream
+from upload import Uploader
+from write_cache import WriteCache
+
+log = logging.getLogger(__name__)
+
+PEER_DOWNLOAD_RATE = REGISTRY.gauge('bt_peer_download_rate_bytes', 'Download rate from each peer in bytes per second')
+PEER_UPLOAD_RATE = REGISTRY.gauge('bt_peer_upload_rate_bytes', 'Upload rate to each peer in bytes per second')
+PEERS = REGISTRY.gauge('bt_peers', 'Connected peers')
+PIECES = REGISTRY.gauge('bt_pieces_completed', 'Verified pieces')
+DOWNLOADED = REGISTRY.gauge('bt_downloaded_bytes', 'Block payload bytes received')
+UPLOADED = REGISTRY.gauge('bt_uploaded_bytes', 'Block payload bytes sent')
+HASH_QUEUE = REGISTRY.gauge('bt_hash_queue_depth', 'Pieces queued on or being hashed by the hash pool')
+PICK_TIME = REGISTRY.histogram('bt_picker_seconds', 'Time to pick the next piece to start',
+                               buckets=(1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2))
 
 class BitTorrentClient: 
-    def __init__(self,torrent_file): 
+    def __init__(self,torrent_file, engine = None, download_dir = '.', listener = None, rate_limiter = None, 
+                 hasher = None, disk_writer = None, tracker_executor = None): 
         self.torrent = TorrentFile(torrent_file)
-        self.tracker = TrackerClient(self.torrent)
+        self.tracker = TrackerClient(self.torrent, tracker_executor)
+
+        # every peer of this client runs on the engine's single event loop, 
+        # which a session shares between all of its torrents 
+        self.owns_engine = engine is None 
+        self.engine = engine or PeerEngine()
+
+        # incoming peers arrive on the port the tracker announces 
+        self.owns_listener = listener is None 
+        self.listener = listener or PeerListener(self.tracker.port)
+        self.tracker.port = self.listener.port 
+
+        # bandwidth caps, shared with other torrents when a limiter is passed in 
+        self.rate_limiter = rate_limiter or RateLimiter()
 
         # peer management 
         self.peers = {} 
-        self.max_peer = 50 
+        self.connecting = {}
+        # candidates from the tracker are scored and dialed a few at a time 
+        self.peer_manager = PeerManager(target_peers=50, max_half_open=8)
 
         # download state 
         self.downloaded_pieces = set() 
         self.piece_data = {}
         self.downloading_pieces = set()
-        self.completed_pieces = set()
-        self.output_file = None
+        self.completed_pieces = Bitfield(self.torrent.num_pieces)
+        self.storage = Storage(self.torrent, download_dir)
+        self.resume = ResumeData(self.torrent, self.storage)
+        self.checking = False 
+        # readers of the data while it downloads, replaced rather than mutated 
+        # since they come and go on other threads 
+        self.streams = []
+
+        # piece selection, availability is kept up to date by peer callbacks 
+        self.picker = PiecePicker(self.torrent.num_pieces)
+
+        # request pipeline: block states and receive buffer of every in-flight piece 
+        self.piece_states = {}
+        self.timed_out = {}
+        # peer -> (state, block, buffer) of a duplicate copy it is receiving 
+        self.block_copies = {}
+
+        # endgame: once every block is requested, outstanding ones are requested 
+        # from every peer that has them and the spare copies cancelled. the 
+        # duplicates are received into buffers of their own (see _block_buffer), 
+        # only the first complete copy goes into the piece 
+        self.endgame = False 
+
+        # completion pipeline: hashes are checked on a worker pool and verified 
+        # pieces are written by a single disk thread, both off the event loop 
+        self.owns_hasher = hasher is None 
+        self.owns_disk_writer = disk_writer is None 
+        self.hasher = hasher or HashPool()
+        self.disk_writer = disk_writer or ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk')
+        self.verifying = {}
+
+        # verified pieces wait in a write-back cache and reach the disk in batches 
+        self.write_cache = WriteCache(self.storage, self.disk_writer)
+
+        # upload path: block requests are answered from disk through a read cache 
+        self.uploader = Uploader(self.torrent, self.storage, self.disk_writer, write_cache=self.write_cache)
+        self.write_cache.on_written = self.uploader.piece_written 
+        self.choker = Choker(upload_slots=4)
 
         #statistics 
         self.upload = 0 
@@ -28,119 +111,534 @@ class BitTorrentClient:
 
         # control 
         self.running = False 
-        self.tracker_thread = None 
-        self.download_thread = None 
+        self.tracker_task = None 
+        self.download_task = None 
 
     def start(self): 
         # start Bittorrent Client 
         print(f"start BitTorrent client for {self.torrent.name}")
         self.running = True 
 
-        # start tracker updates 
-        self.tracker_thread = threading.Thread(target= self.tracker_loop)
-        self.tracker_thread.daemon = True 
-        self.tracker_thread.start()
-
-        # start download coordination 
-        self.download_thread = threading.Thread(target = self.download_loop)
-        self.download_thread.daemon = True 
-        self.download_thread.start() 
+        # a resume file matching the files on disk restores progress as is; 
+        # without one, whatever data is already on disk gets rechecked 
+        completed = self.resume.load()
+        needs_recheck = completed is None and self.storage.has_data()
 
-        # Initialize output file
-        self.output_file = open(self.torrent.name, 'wb')
+        # create the output files at their full size 
+        self.storage.open()
+        if completed: 
+            self._restore_pieces(completed)
+            print(f"Resumed with {len(completed)} of {self.torrent.num_pieces} pieces")
 
-        # Pre-allocate file space
-        self.output_file.seek(self.torrent.length - 1)
-        self.output_file.write(b'\0')
-        self.output_file.flush()
+        # tracker updates and download coordination run as tasks on the engine loop 
+        self.engine.start()
+        self.listener.add_torrent(self.torrent.info_hash, self._accept_peer)
+        try: 
+            self.engine.run(self.listener.start(), timeout=10)
+        except OSError as e: 
+            print(f"Cannot listen on port {self.listener.port}: {e}")
+        if needs_recheck: 
+            self.checking = True 
+            self.engine.submit(self._recheck())
+        self.tracker_task = self.engine.submit(self.tracker_loop())
+        self.download_task = self.engine.submit(self.download_loop())
+        if self.streams: 
+            self.engine.call(self.update_deadlines)
 
         print("BitTorrent client started")
     
-    def tracker_loop(self): 
+    def _restore_pieces(self, pieces): 
+        for piece_index in pieces: 
+            self.completed_pieces.add(piece_index)
+            self.picker.piece_completed(piece_index)
+        # a stream opened before a recheck may be blocked on these already 
+        for stream in self.streams: 
+            for piece_index in pieces: 
+                stream.piece_verified(piece_index)
+
+    async def _recheck(self): 
+        # hash existing data on the hash pool's threads, no piece is requested meanwhile 
+        loop = asyncio.get_running_loop()
+        try: 
+            valid = await loop.run_in_executor(None, recheck, self.torrent, self.storage, self.hasher.executor)
+            self._restore_pieces(valid)
+            # peers connected during the check haven't heard about these yet 
+            for peer in self.peers.values(): 
+                for piece_index in sorted(valid): 
+                    peer.send_have(piece_index)
+                self._count_wanted(peer)
+                self._update_interest(peer)
+        finally: 
+            self.checking = False 
+        # the read windows no longer need the pieces found on disk 
+        if self.streams: 
+            self.update_deadlines()
+
+    def bytes_left(self): 
+        left = self.torrent.length - len(self.completed_pieces) * self.torrent.piece_length 
+        last_piece = self.torrent.num_pieces - 1 
+        if last_piece in self.completed_pieces: 
+            left += self.torrent.piece_length - self.torrent.get_pieces_size(last_piece)
+        return left 
+
+    async def tracker_loop(self): 
         #periodically contact tracker for new peers
+        loop = asyncio.get_running_loop()
         while self.running: 
             try: 
-                left = self.torrent.length - self.download
-                peers, interval = self.tracker.announce(
+                left = self.bytes_left()
+                # the tracker requests are blocking, keep them off the event loop. 
+                # each tier's peers are handed over as soon as that tier answers 
+                peers, interval = await loop.run_in_executor(None, functools.partial(
+                    self.tracker.announce,
                     uploaded= self.upload,
                     downloaded= self.download,
-                    left = left
-                )
-
-                # connect to new peers 
-                for ip, port in peers: 
-                    peer_key = f"{ip}:{port}"
-                    if peer_key not in self.peers and len(self.peers) < self.max_peer : 
-                        peer = PeerConnection(ip, port, self.torrent, self.tracker.peer_id)
-                        if peer.connect(): 
-                            self.peers[peer_key] = peer 
-                            peer.send_interested()
+                    left = left,
+                    need_peers = len(self.peers) + len(self.connecting) < self.peer_manager.target_peers,
+                    on_peers = lambda peers: self.engine.call(self._tracker_peers, peers)
+                ))
                 #wait for the next tracker
-                time.sleep(min(interval,300))
+                await asyncio.sleep(min(interval,300))
+            except asyncio.CancelledError: 
+                raise
             except Exception as e: 
                 print(f"Tracker loop error: {e}")
-                time.sleep(60) # wait 1 min on error 
+                await asyncio.sleep(60) # wait 1 min on error 
+
+    def _tracker_peers(self, peers): 
+        # new addresses join the candidate list, the download loop keeps dialing from it 
+        if self.running: 
+            self.peer_manager.add_candidates(peers)
+            self._refill_peers()
+
+    async def _connect_peer(self, peer_key, ip, port): 
+        # dial a single peer and register it once the handshake succeeds 
+        try: 
+            peer = self._new_peer(ip, port)
+            if await peer.connect() and self.running: 
+                self.peer_manager.connected(peer_key, ip, port)
+                self._peer_ready(peer_key, peer)
+            else: 
+                # stopped while the handshake was in flight 
+                peer.close()
+                self.peer_manager.connect_failed(peer_key)
+        finally: 
+            self.connecting.pop(peer_key, None)
+
+    def _accept_peer(self, transport, ip, port, handshake, extra): 
+        # called by the listener with a handshake for this torrent, incoming 
+        # and outgoing peers share the same connection cap 
+        peer_key = f"{ip}:{port}"
+        if not self.running or peer_key in self.peers or self.peer_manager.is_banned(peer_key): 
+            return False 
+        if handshake[48:68] == self.tracker.peer_id: 
+            return False # we dialed our own listener 
+        if len(self.peers) + len(self.connecting) >= self.peer_manager.target_peers: 
+            return False 
+        peer = self._new_peer(ip, port)
+        if not peer.accept(transport, handshake, extra): 
+            return False 
+        self.peer_manager.connected(peer_key, ip, port, incoming=True)
+        self._peer_ready(peer_key, peer)
+        return True 
+
+    def _new_peer(self, ip, port): 
+        peer = PeerConnection(ip, port, self.torrent, self.tracker.peer_id)
+        peer.on_block_buffer = self._block_buffer
+        peer.on_block = self._block_received
+        peer.on_requests_dropped = self._requests_dropped
+        peer.on_have = self._peer_have
+        peer.on_bitfield = self._peer_bitfield
+        peer.on_unchoke = self._peer_unchoked
+        peer.on_request = self._peer_request
+        peer.on_upload = self._upload_block
+        peer.on_close = self._peer_closed
+        self.rate_limiter.attach(peer, self.torrent.info_hash)
+        return peer 
+
+    def set_rate_limits(self, upload_rate = None, download_rate = None): 
+        # bytes per second for this torrent, 0 lifts the limit 
+        self.rate_limiter.set_torrent(self.torrent.info_hash, upload_rate, download_rate)
+
+    def _peer_ready(self, peer_key, peer): 
+        self.peers[peer_key] = peer 
+        # with the fast extension a complete or empty bitfield is one byte 
+        if peer.supports_fast and self.is_seeding(): 
+            peer.send_have_all()
+        elif self.completed_pieces: 
+            peer.send_bitfield(self.completed_pieces.to_bytes())
+        elif peer.supports_fast: 
+            peer.send_have_none()
+        if peer.supports_extended: 
+            peer.send_extended_handshake(self.listener.port)
+        if peer.supports_fast: 
+            # a few pieces it may fetch from us even while choked, to get started 
+            for piece_index in allowed_fast_set(peer.ip, self.torrent.info_hash, self.torrent.num_pieces): 
+                if piece_index in self.completed_pieces: 
+                    peer.send_allowed_fast(piece_index)
+        self._count_wanted(peer)
+        self._update_interest(peer)
+        # it may have unchoked us in the same read as its handshake 
+        self._fill_requests(peer)
 
-    def download_loop(self): 
+    def _refill_peers(self): 
+        # dial the best candidates toward the target, with a bounded number of 
+        # handshakes in flight at once 
+        busy = self.peers.keys() | self.connecting.keys()
+        slots = min(self.peer_manager.target_peers - len(self.peers) - len(self.connecting), 
+                    self.peer_manager.max_half_open - len(self.connecting))
+        for peer_key, candidate in self.peer_manager.pick(slots, busy): 
+            self.connecting[peer_key] = asyncio.create_task(self._connect_peer(peer_key, candidate.ip, candidate.port))
+
+    def _evict_peers(self, now): 
+        # dead and snubbed connections only make way when there is someone to dial instead 
+        seeding = self.is_seeding()
+        busy = self.peers.keys() | self.connecting.keys()
+        for peer in list(self.peers.values()): 
+            if not self.peer_manager.waiting(busy, now): 
+                break 
+            if self.peer_manager.is_useless(peer, seeding, now): 
+                print(f"Dropping idle peer {peer.ip}:{peer.port}")
+                peer.close()
+
+    async def download_loop(self): 
         #corrdinate piece downloading 
         while self.running: 
             try: 
-                #finding pieces to donwload 
-                available_pieces = self.find_available_pieces()
-                for piece_index in available_pieces: 
-                    if piece_index not in self.downloaded_pieces and piece_index not in self.downloading_pieces: 
-                        # find the peer with this piece 
-                        peer = self._find_peer_with_piece(piece_index)
-                        if peer: 
-                            self._download_piece(peer,piece_index)
-                time.sleep(1)
+                # pipelines are refilled as blocks arrive, this pass re-issues 
+                # stale requests and feeds newly unchoked peers 
+                now = time.monotonic()
+                for peer in list(self.peers.values()): 
+                    if not peer.connected: 
+                        continue 
+                    peer.update_rate(now)
+                    for request_key in peer.expire_requests(now): 
+                        self.timed_out[request_key] = peer 
+                        self._requeue_block(*request_key)
+                    self._fill_requests(peer)
+                self.choker.tick(list(self.peers.values()), self.is_seeding(), now)
+                self.write_cache.tick(now)
+                if len(self.peers) >= self.peer_manager.target_peers: 
+                    self._evict_peers(now)
+                self._refill_peers()
+                self._update_metrics()
+                await asyncio.sleep(0.5)
+            except asyncio.CancelledError: 
+                raise
             except Exception as e: 
                 print(f"download loop error: {e}")
-                time.sleep(3)
-    def find_available_pieces(self): 
-        #find availble pieces from peers 
-        available = set()
-        for peer in self.peers.values():
-            if peer.connected and peer.handshake : 
-                available.update(peer.peer_pieces)
-        return available
-    
-    def _find_peer_with_piece(self, piece_index):
-        #find a peer that has the piece and isn't choking us 
-        candidates = []
-        for peer in self.peers.values(): 
-            if (peer.has_piece(piece_index)and not peer.peer_choking and peer.connected and peer.handshake):
-                candidates.append(peer)
-        if candidates: 
-            return min(candidates,key=lambda p: len(p.pending_request))
-        return None 
+                await asyncio.sleep(3)
+
+    def _update_metrics(self): 
+        torrent = self.torrent.info_hash.hex()
+        for peer_key, peer in self.peers.items(): 
+            PEER_DOWNLOAD_RATE.set(peer.download_rate, torrent=torrent, peer=peer_key)
+            PEER_UPLOAD_RATE.set(self.choker.rates(peer)[1], torrent=torrent, peer=peer_key)
+        PEERS.set(len(self.peers), torrent=torrent)
+        PIECES.set(len(self.completed_pieces), torrent=torrent)
+        DOWNLOADED.set(self.download, torrent=torrent)
+        UPLOADED.set(self.upload, torrent=torrent)
+        HASH_QUEUE.set(self.hasher.pending)
+
+    def _peer_have(self, peer, piece_index): 
+        self.picker.peer_has(piece_index)
+        if piece_index not in self.completed_pieces: 
+            peer.wanted_pieces += 1 
+        # like a bitfield, a HAVE in the same read as the handshake waits for 
+        # _peer_ready, our bitfield has to be the first message we send 
+        if self.peers.get(f"{peer.ip}:{peer.port}") is peer: 
+            if not peer.am_interested and piece_index not in self.completed_pieces: 
+                peer.send_interested()
+            self._fill_requests(peer)
+
+    def _peer_bitfield(self, peer, old): 
+        # old is what the peer had announced before, usually nothing 
+        if old: 
+            self.picker.remove_peer(old)
+        self.picker.add_peer(peer.peer_pieces)
+        self._count_wanted(peer)
+        # a bitfield that arrives along with the handshake is handled before 
+        # the peer is ready, _peer_ready sends our bitfield first then 
+        if self.peers.get(f"{peer.ip}:{peer.port}") is peer: 
+            self._update_interest(peer)
+            self._fill_requests(peer)
+
+    def _peer_unchoked(self, peer): 
+        # request at once instead of on the next tick of the download loop 
+        if self.peers.get(f"{peer.ip}:{peer.port}") is peer: 
+            self._fill_requests(peer)
+
+    def _count_wanted(self, peer): 
+        # one AND-NOT over the bitmaps, HAVEs and completed pieces keep the 
+        # count current from there on 
+        peer.wanted_pieces = len(peer.peer_pieces.difference(self.completed_pieces))
+
+    def _update_interest(self, peer): 
+        # interested exactly while the peer has pieces we still need 
+        wanted = peer.wanted_pieces > 0 
+        if wanted and not peer.am_interested: 
+            peer.send_interested()
+        elif not wanted and peer.am_interested: 
+            peer.send_not_interested()
+
+    def _peer_closed(self, peer): 
+        peer_key = f"{peer.ip}:{peer.port}"
+        if self.peers.get(peer_key) is peer: 
+            del self.peers[peer_key]
+            self.peer_manager.disconnected(peer_key, peer)
+            PEER_DOWNLOAD_RATE.remove(torrent=self.torrent.info_hash.hex(), peer=peer_key)
+            PEER_UPLOAD_RATE.remove(torrent=self.torrent.info_hash.hex(), peer=peer_key)
+        self.picker.remove_peer(peer.peer_pieces)
+        self.choker.remove_peer(peer)
+        # a block it was receiving into a piece buffer is free for others 
+        self.block_copies.pop(peer, None)
+        if peer.block_key is not None: 
+            state = self.piece_states.get(peer.block_key[0])
+            if state is not None: 
+                state.unclaim(peer.block_key[1] // state.block_size, peer)
+
+    def _peer_request(self, peer, piece_index, begin, length): 
+        # only blocks of verified pieces are served 
+        if piece_index not in self.completed_pieces: 
+            return False 
+        return begin + length <= self.torrent.get_pieces_size(piece_index)
+
+    async def _upload_block(self, peer, piece_index, begin, length): 
+        await self.uploader.send_block(peer, piece_index, begin, length)
+        self.upload += length 
+
+    def _fill_requests(self, peer): 
+        # top the peer's pipeline up to its adaptive queue depth 
+        if peer.peer_choking and peer.allowed_fast: 
+            # allowed fast pieces we have completed since are of no more use 
+            peer.allowed_fast = {i for i in peer.allowed_fast if i not in self.completed_pieces}
+        if (peer.peer_choking and not peer.allowed_fast) or not peer.handshake or not peer.connected or self.checking: 
+            return 
+        slots = peer.target_queue - len(peer.pending_request)
+        while slots > 0: 
+            duplicate = False 
+            block = self._next_block(peer)
+            if block is None and self._in_endgame(): 
+                block = self._endgame_block(peer)
+                duplicate = True 
+            elif block is None and self.picker.deadlines: 
+                block = self._overdue_block(peer)
+                duplicate = True 
+            if block is None: 
+                break 
+            state, block = block 
+            if not peer.request_piece(state.index, block * state.block_size, state.block_length(block)): 
+                if not duplicate: 
+                    state.release(block)
+                break 
+            slots -= 1 
+
+    def _in_endgame(self): 
+        # every piece is started and every block of them requested 
+        if self.picker.wanted or any(state.has_free() for state in self.piece_states.values()): 
+            return False 
+        if not self.endgame and self.piece_states: 
+            self.endgame = True 
+            print(f"Entering endgame with {len(self.piece_states)} pieces left")
+        return self.endgame 
+
+    def _endgame_block(self, peer, states = None): 
+        # the outstanding block this peer has that the fewest peers are fetching 
+        best = None 
+        best_count = None 
+        peers = [other for other in self.peers.values() if other.pending_request]
+        for piece_index, state in (self.piece_states if states is None else states).items(): 
+            if not peer.can_request(piece_index): 
+                continue 
+            for block in state.missing(): 
+                request_key = (piece_index, block * state.block_size)
+                if request_key in peer.pending_request: 
+                    continue 
+                count = sum(1 for other in peers if request_key in other.pending_request)
+                if best is None or count < best_count: 
+                    best, best_count = (state, block), count 
+                    if not count: 
+                        return best 
+        return best 
+
+    def _overdue_block(self, peer): 
+        # pieces past their deadline are raced between peers like in endgame 
+        now = time.monotonic()
+        deadlines = self.picker.deadlines 
+        overdue = {piece_index: state for piece_index, state in self.piece_states.items() 
+                   if deadlines.get(piece_index, math.inf) <= now}
+        return self._endgame_block(peer, overdue) if overdue else None 
+
+    def _next_block(self, peer): 
+        # finish pieces already in flight before starting a new one; a block 
+        # only goes back to the peer it timed out on when nothing else is left 
+        fallback = None 
+        states = self.piece_states.items()
+        if self.picker.deadlines: 
+            # with a stream reading, the pieces due soonest are finished first 
+            deadlines = self.picker.deadlines 
+            states = sorted(states, key=lambda item: (deadlines.get(item[0], math.inf), item[0]))
+        for piece_index, state in states: 
+            if not peer.can_request(piece_index): 
+                continue 
+            block = state.free_block()
+            while block is not None: 
+                request_key = (piece_index, block * state.block_size)
+                if request_key in peer.pending_request: 
+                    pass # still outstanding here from before the endgame 
+                elif self.timed_out.get(request_key) is not peer: 
+                    state.request(block)
+                    return state, block 
+                elif fallback is None: 
+                    fallback = state, block 
+                block = state.free_block(block + 1)
+        if self.hasher.full(): 
+            # let verification catch up before buffering more pieces 
+            piece_index = None 
+        else: 
+            started_at = time.perf_counter()
+            if peer.peer_choking: 
+                # a choking peer serves only the few pieces it allowed fast 
+                piece_index = self.picker.pick_from(peer.allowed_fast, peer.can_request)
+            else: 
+                piece_index = self.picker.pick(peer.can_request, peer.peer_pieces)
+            PICK_TIME.observe(time.perf_counter() - started_at)
+        if piece_index is not None: 
+            state = self._download_piece(piece_index)
+            state.request(0)
+            return state, 0 
+        if fallback is not None: 
+            fallback[0].request(fallback[1])
+        return fallback 
     
-    def _download_piece(self,peer,piece_index): 
-        #download a complete piece from a peer
+    def _download_piece(self,piece_index): 
+        #start tracking the blocks of a piece 
+        self.endgame = False 
         self.downloading_pieces.add(piece_index)
-        piece_size = self.torrent.get_pieces_size(piece_index)
-        block_size = 16384 
-
-        #request all the blocks for this piece 
-        for offset in range(0, piece_size, block_size): 
-            length = min (block_size, piece_size -offset)
-            peer.request_piece (piece_index, offset, length)
-        print(f"Started downloading piece {piece_index}")
+        state = self.piece_states[piece_index] = PieceState(piece_index, self.torrent.get_pieces_size(piece_index), 
+                                                            PeerConnection.BLOCK_SIZE)
+        log.debug("Started downloading piece %d", piece_index)
+        return state 
+
+    def _requeue_block(self, piece_index, begin): 
+        # a block that is no longer outstanding can be requested again 
+        state = self.piece_states.get(piece_index)
+        if state is not None: 
+            state.release(begin // state.block_size)
+
+    def _requests_dropped(self, peer, request_keys): 
+        # the peer choked us or went away, its requests need another home 
+        for piece_index, begin in request_keys: 
+            self._requeue_block(piece_index, begin)
+
+    def _wanted_block(self, piece_index, begin, length): 
+        # the state and block index of a block still missing, or None 
+        state = self.piece_states.get(piece_index)
+        if state is None: 
+            return None 
+        block = state.block_at(begin, length)
+        if block is None or state.is_received(block): 
+            return None 
+        return state, block 
+
+    def _block_buffer(self, peer, piece_index, begin, length): 
+        # where an incoming block should be received, None if it isn't needed. 
+        # one peer at a time receives a block into the piece buffer; a copy 
+        # from anyone else (endgame, a re-issued or unsolicited block) gets a 
+        # buffer of its own, so bytes that differ never land in a piece that 
+        # is being hashed or was already verified 
+        wanted = self._wanted_block(piece_index, begin, length)
+        if wanted is None: 
+            return None 
+        state, block = wanted 
+        if state.claim(block, peer): 
+            return memoryview(state.buffer)[begin:begin + length]
+        copy = bytearray(length)
+        self.block_copies[peer] = (state, block, copy)
+        return memoryview(copy)
+
+    def _block_received(self, peer, piece_index, begin, length): 
+        # record a block from any peer and keep that peer's pipeline full 
+        self.download += length 
+        copy = self.block_copies.pop(peer, None)
+        wanted = self._wanted_block(piece_index, begin, length)
+        if wanted is not None: 
+            state, block = wanted 
+            writer = state.writers.get(block)
+            if writer is not peer: 
+                # only a copy taken for this very piece state may stand in 
+                if copy is None or copy[0] is not state or copy[1] != block: 
+                    self._fill_requests(peer)
+                    return 
+                state.buffer[begin:begin + length] = copy[2]
+                if writer is not None: 
+                    writer.detach_block(piece_index, begin)
+            state.writers.pop(block, None)
+            state.receive(block, peer)
+            self.timed_out.pop((piece_index, begin), None)
+            if self.endgame or piece_index in self.picker.deadlines: 
+                # the first copy is in, withdraw the duplicate requests; one that 
+                # is already arriving was detached from the piece buffer above 
+                for other in self.peers.values(): 
+                    if other is not peer: 
+                        other.cancel_request(piece_index, begin, length)
+            if state.complete(): 
+                self._complete_piece(piece_index)
+        self._fill_requests(peer)
+
+    def _complete_piece(self, piece_index): 
+        """Queue a complete piece for verification straight from its receive buffer"""
+        state = self.piece_states.pop(piece_index)
+        if self.timed_out: 
+            for block in range(len(state)): 
+                self.timed_out.pop((piece_index, block * state.block_size), None)
+        self.downloading_pieces.discard(piece_index)
+        self.verifying[piece_index] = asyncio.create_task(self._verify_piece(piece_index, state.buffer, state.peers))
+
+    async def _verify_piece(self, piece_index, piece_data, peers): 
+        # hash on the worker pool, then hand the piece to the writer or back to the picker 
+        try: 
+            ok = await self.hasher.verify(piece_data, self.torrent.pieces_hash[piece_index])
+        finally: 
+            self.verifying.pop(piece_index, None)
+        if ok: 
+            self.piece_completed(piece_index, piece_data)
+        else: 
+            log.warning("Piece %d hash verification failed", piece_index)
+            self.picker.piece_failed(piece_index)
+            for peer in peers: 
+                self._penalize(peer, 1 / len(peers))
+
+    def _penalize(self, peer, share): 
+        # a corrupt piece counts against every peer that contributed to it, 
+        # split between them so one bad peer can't get honest ones banned 
+        peer_key = f"{peer.ip}:{peer.port}"
+        if self.peer_manager.hash_failure(peer_key, share): 
+            print(f"Banning {peer_key} for sending corrupt pieces")
+            peer.close()
     
     def piece_completed(self, piece_index, piece_data):
         """Handle a completed piece"""
         if piece_index not in self.completed_pieces:
+            # into the write cache first, a stream that sees the piece as 
+            # completed reads it from there or from disk 
+            self.write_cache.add(piece_index, piece_data)
             self.completed_pieces.add(piece_index)
             self.downloading_pieces.discard(piece_index)
-            
-            # Write piece to file
-            if self.output_file:
-                offset = piece_index * self.torrent.piece_length
-                self.output_file.seek(offset)
-                self.output_file.write(piece_data)
-                self.output_file.flush()
-            
-            print(f"Piece {piece_index} written to file")
+            self.picker.piece_completed(piece_index)
+            self.uploader.add_piece(piece_index, piece_data)
+            for stream in self.streams: 
+                stream.piece_verified(piece_index)
+            for peer in self.peers.values(): 
+                peer.send_have(piece_index)
+                if piece_index in peer.peer_pieces: 
+                    # this may have been the last piece we needed from the peer 
+                    peer.wanted_pieces -= 1 
+                    self._update_interest(peer)
+            if self.is_seeding(): 
+                print("Download complete, now seeding")
+                asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                    self.tracker.announce, uploaded=self.upload, downloaded=self.download, left=0, event='completed'))
 
     def verify_piece(self, piece_index, data):
         """Verify a piece against its hash"""
@@ -148,6 +646,33 @@ class BitTorrentClient:
         actual_hash = hashlib.sha1(data).digest()
         return expected_hash == actual_hash
     
+    def open_stream(self, window = 16, rate = 0): 
+        """File-like reader of the torrent's data that can start before the 
+        download is complete, see TorrentStream"""
+        stream = TorrentStream(self, window, rate)
+        self.streams = self.streams + [stream]
+        return stream 
+
+    def close_stream(self, stream): 
+        self.streams = [other for other in self.streams if other is not stream]
+        if self.engine.loop is not None: 
+            self.engine.call(self.update_deadlines)
+
+    def update_deadlines(self): 
+        # merge the read windows of every open stream into piece deadlines, 
+        # runs on the engine loop whenever a stream moves 
+        deadlines = {}
+        for stream in self.streams: 
+            for piece_index, deadline in stream.deadlines().items(): 
+                if piece_index not in self.completed_pieces: 
+                    deadlines[piece_index] = min(deadline, deadlines.get(piece_index, deadline))
+        self.picker.set_deadlines(deadlines)
+        for peer in list(self.peers.values()): 
+            self._fill_requests(peer)
+
+    def is_seeding(self): 
+        return len(self.completed_pieces) == self.torrent.num_pieces 
+
     def get_progress(self):
         """Get download progress"""
         return len(self.completed_pieces) / self.torrent.num_pieces
@@ -156,24 +681,53 @@ class BitTorrentClient:
         """Stop the BitTorrent client"""
         print("Stopping BitTorrent client...")
         self.running = False
+        for stream in self.streams: 
+            stream.close()
         
         # Close all peer connections
-        for peer in list(self.peers.values()):
-            peer.close()
+        if self.engine.loop is not None:
+            try:
+                self.engine.run(self._close_peers(), timeout=10)
+            except Exception:
+                pass
         
         # Send stop event to tracker
         try:
             self.tracker.announce(
                 uploaded=self.upload,
                 downloaded=self.download,
-                left=self.torrent.length - self.download,
+                left=self.bytes_left(),
                 event='stopped'
             )
         except:
             pass
+        self.tracker.close()
         
-        # Close output file
-        if self.output_file:
-            self.output_file.close()
+        if self.owns_engine: 
+            self.engine.stop()
+        # cached pieces go to disk, after anything already queued on the writer 
+        self.write_cache.close()
+        if self.owns_hasher: 
+            self.hasher.shutdown()
+        if self.owns_disk_writer: 
+            self.disk_writer.shutdown(wait=True)
+
+        # flush and close the output files, then record what they hold 
+        if self.storage.fds:
+            self.storage.close()
+            self.resume.save(self.completed_pieces)
         print("Bittorrent client stop")
 
+    async def _close_peers(self):
+        self.listener.remove_torrent(self.torrent.info_hash)
+        for metric in (PEERS, PIECES, DOWNLOADED, UPLOADED): 
+            metric.remove(torrent=self.torrent.info_hash.hex())
+        self.rate_limiter.remove_torrent(self.torrent.info_hash)
+        if self.owns_listener: 
+            self.listener.close()
+        for task in (self.tracker_task, self.download_task, *self.connecting.values(), *self.verifying.values()):
+            if task:
+                task.cancel()
+        for peer in list(self.peers.values()):
+            peer.close()
+
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+
+class PeerEngine:
+    """Run every peer connection on one asyncio event loop in a single thread"""
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+
+    def start(self):
+        # start the event loop thread (no-op if already running)
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        # schedule a coroutine on the engine loop from any thread
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, func, *args):
+        # run a plain callable on the engine loop from any thread
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def run(self, coro, timeout=None):
+        # run a coroutine on the engine loop and wait for its result
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        """Cancel outstanding tasks and stop the event loop"""
+        if self.loop is None:
+            return
+        try:
+            self.run(self._cancel_tasks(), timeout=10)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=10)
+        self.loop.close()
+        self.loop = None
+        self.thread = None
+
+    async def _cancel_tasks(self):
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks() if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
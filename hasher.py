@@ -0,0 +1,34 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HashPool:
+    """Verify piece hashes on worker threads so the event loop keeps reading"""
+
+    def __init__(self, max_workers = None, max_pending = 64):
+        # hashlib releases the GIL while hashing, so the workers run in parallel
+        self.executor = ThreadPoolExecutor(max_workers or os.cpu_count() or 1, thread_name_prefix='hasher')
+        self.max_pending = max_pending
+        self.pending = 0
+
+    def full(self):
+        # callers stop starting new pieces while the queue is at capacity
+        return self.pending >= self.max_pending
+
+    async def verify(self, data, expected_hash):
+        """Return True if the SHA-1 of data matches expected_hash"""
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self._matches, data, expected_hash)
+        finally:
+            self.pending -= 1
+
+    @staticmethod
+    def _matches(data, expected_hash):
+        return hashlib.sha1(data).digest() == expected_hash
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,79 @@
+import asyncio
+
+
+class IncomingHandshake(asyncio.Protocol):
+    """Reads the handshake of an accepted connection, then hands the socket
+    to the torrent it names"""
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.transport = None
+        self.buffer = bytearray()
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.listener.pending >= self.listener.max_pending:
+            transport.close()
+            return
+        self.listener.pending += 1
+        self.timer = asyncio.get_running_loop().call_later(self.listener.HANDSHAKE_TIMEOUT, transport.close)
+
+    def connection_lost(self, exc):
+        self._done()
+
+    def data_received(self, data):
+        self.buffer += data
+        if len(self.buffer) < 68:
+            return
+        self._done()
+        handshake = bytes(self.buffer[:68])
+        accept = None
+        if handshake[0] == 19 and handshake[1:20] == b"BitTorrent protocol":
+            accept = self.listener.torrents.get(handshake[28:48])
+        ip, port = self.transport.get_extra_info('peername')[:2]
+        # the torrent takes over the transport, or turns the peer away
+        if accept is None or not accept(self.transport, ip, port, handshake, bytes(self.buffer[68:])):
+            self.transport.close()
+
+    def _done(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            self.listener.pending -= 1
+
+
+class PeerListener:
+    """Accepts incoming peer connections on the port announced to trackers.
+
+    The handshake names the torrent, so one listening socket can serve every
+    torrent registered with add_torrent.
+    """
+
+    HANDSHAKE_TIMEOUT = 10
+
+    def __init__(self, port = 6681, max_pending = 32):
+        self.port = port
+        self.max_pending = max_pending
+        self.pending = 0
+        self.server = None
+        # info_hash -> accept(transport, ip, port, handshake, extra), True if taken
+        self.torrents = {}
+
+    async def start(self):
+        if self.server is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: IncomingHandshake(self), port=self.port, reuse_address=True)
+        print(f"Listening for peers on port {self.port}")
+
+    def add_torrent(self, info_hash, accept):
+        self.torrents[info_hash] = accept
+
+    def remove_torrent(self, info_hash):
+        self.torrents.pop(info_hash, None)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
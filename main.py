@@ -1,33 +1,47 @@
+import argparse
+import logging
 import sys
 import time
-from client import BitTorrentClient
+import metrics
+from session import Session
 
 def main(): 
-    if len(sys.argv) != 2: 
-        print("Usage: python main.py <torrent_file>")
-        sys.exit(1)
-    torrent_file = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Download and seed torrents")
+    parser.add_argument('torrent_files', nargs='+', metavar='torrent_file')
+    parser.add_argument('--log-level', default='INFO', help="DEBUG also logs every block and message")
+    parser.add_argument('--metrics-port', type=int, help="serve Prometheus metrics on this port")
+    parser.add_argument('--metrics-json', metavar='PATH', help="write a JSON metrics snapshot to PATH every 10 s")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(message)s')
     try:
-        # Create and start client
-        client = BitTorrentClient(torrent_file)
-        client.start()
+        if args.metrics_port: 
+            metrics.serve(args.metrics_port)
+        if args.metrics_json: 
+            metrics.write_snapshots(args.metrics_json)
+
+        # every torrent runs in one session sharing its threads and listen port 
+        session = Session()
+        clients = [session.add(torrent_file) for torrent_file in args.torrent_files]
+        session.start()
         
         # Monitor progress
         print("Starting download... Press Ctrl+C to stop")
         try:
-            while client.running:
-                progress = client.get_progress()
-                print(f"Progress: {progress:.1%} - Peers: {len(client.peers)}")
+            while session.running:
+                for client in clients: 
+                    progress = client.get_progress()
+                    state = 'queued' if client.torrent.info_hash in session.queued() else f"Peers: {len(client.peers)}"
+                    print(f"{client.torrent.name}: {progress:.1%} - {state}")
                 time.sleep(10)
         except KeyboardInterrupt:
             print("\nShutting down...")
         
         # Clean shutdown
-        client.stop()
+        session.stop()
         
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
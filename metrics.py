@@ -0,0 +1,191 @@
+import bisect
+import http.server
+import json
+import math
+import os
+import threading
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra = ()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        # label key -> value
+        self.values = {}
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(_label_key(labels), None)
+
+    def samples(self):
+        # (suffix, label key, extra labels, value) of everything to export
+        with self.lock:
+            return [('', key, (), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    """Monotonic count, e.g. bytes or pieces"""
+
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down, e.g. a queue depth or a rate"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    """Distribution of observations over fixed upper bounds, in seconds"""
+
+    kind = 'histogram'
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help, buckets = None):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets or self.BUCKETS)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            state[0][position] += 1
+            state[1] += 1
+            state[2] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, count, total) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+                samples.append(('_count', key, (), count))
+                samples.append(('_sum', key, (), total))
+        return samples
+
+
+class Registry:
+    """Named metrics, exported as Prometheus text or as a JSON snapshot"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help, buckets = None):
+        return self._get(Histogram, name, help, buckets)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, key, extra, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(key, extra)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Every metric as plain data, for a JSON dump"""
+        snapshot = {}
+        for metric in list(self.metrics.values()):
+            for suffix, key, extra, value in metric.samples():
+                snapshot.setdefault(metric.name + suffix, []).append({'labels': dict(key + extra), 'value': value})
+        return snapshot
+
+
+# the process-wide registry every module records into
+REGISTRY = Registry()
+
+
+def serve(port, registry = REGISTRY, host = ''):
+    """Serve the registry at http://host:port/metrics on a daemon thread,
+    as Prometheus text, or as JSON with ?format=json"""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if path != '/metrics':
+                self.send_error(404)
+                return
+            if 'format=json' in query:
+                body, content_type = json.dumps(registry.snapshot()).encode(), 'application/json'
+            else:
+                body, content_type = registry.render().encode(), 'text/plain; version=0.0.4'
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def write_snapshots(path, interval = 10, registry = REGISTRY):
+    """Rewrite path with a JSON snapshot every interval seconds on a daemon
+    thread, return an Event that stops it"""
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            with open(path + '.tmp', 'w') as f:
+                json.dump(registry.snapshot(), f)
+            # readers never see a half written file
+            os.replace(path + '.tmp', path)
+
+    threading.Thread(target=run, name='metrics-snapshot', daemon=True).start()
+    return stop
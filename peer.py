@@ -1,10 +1,21 @@
-import socket 
+import asyncio
+import collections
+import logging
+import math
+import hashlib
+import ipaddress
 import struct 
-import threading 
 import time 
 from torrent import * 
+from bencode import Bencode
+from bitfield import Bitfield
+from metrics import REGISTRY 
 
-class PeerConnection:
+log = logging.getLogger(__name__)
+
+REQUEST_RTT = REGISTRY.histogram('bt_request_rtt_seconds', 'Round trip time of handshakes and probe block requests')
+
+class PeerConnection(asyncio.BufferedProtocol):
     CHOKE = 0
     UNCHOKE = 1
     INTERESTED = 2
@@ -14,13 +25,46 @@ class PeerConnection:
     REQUEST = 6
     PIECE = 7
     CANCEL = 8
+    # fast extension, BEP 6 
+    SUGGEST_PIECE = 13 
+    HAVE_ALL = 14 
+    HAVE_NONE = 15 
+    REJECT_REQUEST = 16 
+    ALLOWED_FAST = 17 
+    # extension protocol, BEP 10 
+    EXTENDED = 20 
+    EXTENDED_HANDSHAKE = 0 
+
+    # reserved handshake bits we set, as (byte, mask) 
+    RESERVED_EXTENDED = (5, 0x10)
+    RESERVED_FAST = (7, 0x04)
+    ALLOWED_FAST_COUNT = 10 
+    CLIENT_NAME = b'python-bt'
+
+    # request pipeline tuning 
+    BLOCK_SIZE = 16384 
+    MIN_QUEUE = 4 
+    MAX_QUEUE = 250 
+    QUEUE_TIME = 0.5 # seconds of data kept in flight on top of the round trip 
+    MIN_REQUEST_TIMEOUT = 4 
+    MAX_REQUEST_TIMEOUT = 20 
+    RATE_INTERVAL = 1.0 
+
+    # receive path 
+    RECV_BUFFER_SIZE = 65536 
+    HEADER_SIZE = 13 # length, id, index and begin of a PIECE message 
+    MAX_MESSAGE_SIZE = 1 << 21 
+
+    # upload path 
+    MAX_REQUEST_LENGTH = 131072 
+    MAX_UPLOAD_QUEUE = 256 
 
     def __init__(self, ip, port, torrent, peer_id): 
         self.ip = ip 
         self.port = port 
         self.torrent = torrent 
         self.peer_id = peer_id 
-        self.socket = None 
+        self.transport = None 
         self.connected = False 
         self.handshake = False 
 
@@ -31,138 +75,556 @@ class PeerConnection:
         self.am_interested = False 
 
         #pieces available 
-        self.peer_pieces = set() 
+        self.peer_pieces = Bitfield(torrent.num_pieces) 
+        # how many of those the client still needs, the client keeps it current 
+        self.wanted_pieces = 0 
         self.pending_request = {} 
-        self.piece_blocks = {}  
+
+        # extensions both sides announced in the handshake 
+        self.supports_fast = False 
+        self.supports_extended = False 
+        # pieces the peer lets us request while it chokes us, and the ones we 
+        # serve it while we choke it 
+        self.allowed_fast = set()
+        self.granted_fast = set()
+        # from the peer's extended handshake 
+        self.extensions = {}
+        self.client_name = None 
+        self.max_requests = None 
+
+        # request pipeline: queue depth follows the bandwidth-delay product 
+        self.target_queue = self.MIN_QUEUE 
+        self.download_rate = 0.0 
+        self.rtt = None 
+        self.rtt_probe = None 
+        self.rate_bytes = 0 
+        self.rate_start = time.monotonic()
+        self.last_block_at = 0.0 
+
+        # callbacks into the client 
+        self.on_block_buffer = None 
+        self.on_block = None 
+        self.on_requests_dropped = None 
+        self.on_have = None 
+        self.on_bitfield = None 
+        self.on_unchoke = None 
+        self.on_request = None 
+        self.on_upload = None 
+        self.on_close = None 
          
-         #threading 
+        # receive path: messages are parsed out of a reusable scratch buffer, 
+        # block payloads are received straight into the client's piece buffer 
+        self.recv_buffer = bytearray(self.RECV_BUFFER_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.recv_start = 0 
+        self.recv_end = 0 
+        self.block_view = None 
+        self.block_filled = 0 
+        self.block_key = None 
+        self.handshake_done = None 
+
+        # writer coroutine, runs on the engine loop. protocol messages go out 
+        # before block uploads, which stay cancellable until they are sent 
         self.running = False 
-        self.message_thread = None 
+        self.send_queue = collections.deque()
+        self.upload_queue = collections.OrderedDict()
+        self.send_wakeup = asyncio.Event()
+        self.write_ready = asyncio.Event()
+        self.write_ready.set()
+        self.writer_task = None 
+
+        # transfer totals, the choker turns them into rates 
+        self.downloaded = 0 
+        self.uploaded = 0 
+        self.connected_at = 0.0 
+
+        # rate limits: token buckets of the peer, its torrent and the process, 
+        # reads are paused while any of them is in debt 
+        self.upload_buckets = ()
+        self.download_buckets = ()
+        self.read_paused = False 
+        self.resume_handle = None 
 
-    def connect(self): 
+    async def connect(self, timeout = 10): 
         # connect to peer and perform handshake 
+        loop = asyncio.get_running_loop()
         try: 
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(10)
-            self.socket.connect((self.ip, self.port))
-            self.connected = True 
+            self.handshake_done = loop.create_future()
+            await asyncio.wait_for(loop.create_connection(lambda: self, self.ip, self.port), timeout)
 
             #send handshake 
             handshake = self._build_handshake()
-            self.socket.send(handshake)
+            sent_at = time.monotonic()
+            self.transport.write(handshake)
 
             #receive handshake response 
-            response = self.socket.recv(68)
-            if len(response)== 68 and response[28:48]== self.torrent.info_hash: 
-                self.handshake = True
-                print(f"Handshake successful with {self.ip} : {self.port}")
+            if await asyncio.wait_for(self.handshake_done, timeout): 
+                if not self.connected: 
+                    # closed by a message that came in the same read as the handshake 
+                    return False 
+                # the handshake round trip seeds the rtt estimate 
+                self._sample_rtt(time.monotonic() - sent_at)
+                log.info("Handshake successful with %s:%s", self.ip, self.port)
 
-                #message handling thread 
-                self.running = True 
-                self.message_thread = threading.Thread(target=self._handle_message )
-                self.message_thread.daemon = True 
-                self.message_thread.start()
+                #message writing coroutine 
+                self.writer_task = asyncio.create_task(self._write_loop())
 
                 return True 
             else: 
-                print(f'Handshake failed with {self.ip}: {self.port}')
+                log.info("Handshake failed with %s:%s", self.ip, self.port)
+                self.close()
                 return False 
         except Exception as e: 
-            print(f"Connection failed with {self.ip}: {self.port}: {e}")
+            log.info("Connection failed with %s:%s: %r", self.ip, self.port, e)
+            self.close()
             return False 
         
+    def accept(self, transport, handshake, extra = b''): 
+        # take over an incoming connection once the listener has read its handshake 
+        transport.set_protocol(self)
+        self.connection_made(transport)
+        if not self._receive_handshake(handshake): 
+            return False 
+        transport.write(self._build_handshake())
+        log.info("Accepted connection from %s:%s", self.ip, self.port)
+        self.writer_task = asyncio.create_task(self._write_loop())
+        # messages that came in the same read as the handshake are parsed 
+        # once the caller has registered the peer 
+        if extra: 
+            self._compact(len(extra))
+            self.recv_buffer[self.recv_end:self.recv_end + len(extra)] = extra 
+            self.recv_end += len(extra)
+            asyncio.get_running_loop().call_soon(self._parse_messages)
+        return True 
+
     def _build_handshake(self): 
         protocol = b"BitTorrent protocol"
         pstrlen = len(protocol)
-        reserved = b'\x00' *8 
+        reserved = bytearray(8)
+        for byte, mask in (self.RESERVED_EXTENDED, self.RESERVED_FAST): 
+            reserved[byte] |= mask 
 
         return struct.pack(f'B{pstrlen}s8s20s20s',pstrlen,protocol,reserved,self.torrent.info_hash, self.peer_id)
     
-    def _handle_message(self): 
-        #handle incoming message from peer 
+    def connection_made(self, transport): 
+        self.transport = transport 
+        self.connected = True 
+        self.connected_at = time.monotonic()
+
+    def connection_lost(self, exc): 
+        self.close()
+
+    def pause_writing(self): 
+        self.write_ready.clear()
+
+    def resume_writing(self): 
+        self.write_ready.set()
+
+    def get_buffer(self, sizehint): 
+        # hand the transport the memory its next recv_into should fill 
+        if self.block_view is not None: 
+            return self.block_view[self.block_filled:]
+        needed = self._bytes_needed()
+        if self.recv_end + needed > len(self.recv_buffer): 
+            self._compact(needed)
+        if self.pending_request and self._at_block_header(): 
+            # read no further than the PIECE header so the payload that 
+            # follows lands in the piece buffer instead of in scratch 
+            return self.recv_view[self.recv_end:self.recv_end + needed]
+        return self.recv_view[self.recv_end:]
+
+    def buffer_updated(self, nbytes): 
+        if self.download_buckets: 
+            self._throttle_download(nbytes)
+        if self.block_view is not None: 
+            self.block_filled += nbytes 
+            if self.block_filled == len(self.block_view): 
+                self._finish_block()
+            return 
+        self.recv_end += nbytes 
+        self._parse_messages()
+
+    def _throttle_download(self, nbytes): 
+        now = time.monotonic()
+        delay = max(bucket.consume(nbytes, now) for bucket in self.download_buckets)
+        if delay > 0 and not self.read_paused: 
+            self.read_paused = True 
+            self.transport.pause_reading()
+            self.resume_handle = asyncio.get_running_loop().call_later(delay, self._resume_reading)
+
+    def _resume_reading(self): 
+        # limits may have changed or other peers drawn on a shared bucket meanwhile 
+        self.resume_handle = None 
+        if not self.connected: 
+            return 
+        delay = max(bucket.delay() for bucket in self.download_buckets)
+        if delay > 0: 
+            self.resume_handle = asyncio.get_running_loop().call_later(delay, self._resume_reading)
+            return 
+        self.read_paused = False 
+        self.transport.resume_reading()
+
+    async def _throttle_upload(self, nbytes): 
+        now = time.monotonic()
+        delay = max(bucket.consume(nbytes, now) for bucket in self.upload_buckets)
+        while delay > 0 and self.connected: 
+            await asyncio.sleep(delay)
+            delay = max(bucket.delay() for bucket in self.upload_buckets)
+
+    def _bytes_needed(self): 
+        # bytes still missing before the buffered data can be acted on 
+        available = self.recv_end - self.recv_start 
+        if not self.handshake: 
+            return 68 - available 
+        if self._at_block_header(): 
+            return self.HEADER_SIZE - available 
+        length = struct.unpack_from('!I', self.recv_buffer, self.recv_start)[0]
+        return 4 + length - available 
+
+    def _at_block_header(self): 
+        # true unless the buffer starts with a message other than PIECE 
+        available = self.recv_end - self.recv_start 
+        return available < 5 or self.recv_buffer[self.recv_start + 4] == self.PIECE 
+
+    def _compact(self, needed): 
+        # move unread bytes to the front, growing the buffer for large messages 
+        available = self.recv_end - self.recv_start 
+        if available + needed > len(self.recv_buffer): 
+            buffer = bytearray(available + needed)
+            buffer[:available] = self.recv_view[self.recv_start:self.recv_end]
+            self.recv_buffer = buffer 
+            self.recv_view = memoryview(buffer)
+        else: 
+            self.recv_buffer[:available] = self.recv_view[self.recv_start:self.recv_end]
+        self.recv_start = 0 
+        self.recv_end = available 
+
+    def _parse_messages(self): 
+        # handle every complete message sitting in the scratch buffer 
+        buffer = self.recv_buffer 
+        while self.connected: 
+            start = self.recv_start 
+            available = self.recv_end - start 
+            if not self.handshake: 
+                if available < 68: 
+                    break 
+                self.recv_start = start + 68 
+                if not self._receive_handshake(self.recv_view[start:start + 68]): 
+                    break 
+                continue 
+            if available < 4: 
+                break 
+            length = struct.unpack_from('!I', buffer, start)[0]
+            if length == 0: #keep message alive 
+                self.recv_start = start + 4 
+                continue 
+            if length > self.MAX_MESSAGE_SIZE: 
+                log.warning("Oversized message from %s:%s", self.ip, self.port)
+                self.close()
+                break 
+            if available < 5: 
+                break 
+            if buffer[start + 4] == self.PIECE and length >= 9: 
+                if available < self.HEADER_SIZE: 
+                    break 
+                piece_index, begin = struct.unpack_from('!II', buffer, start + 5)
+                self.recv_start = start + self.HEADER_SIZE 
+                self._start_block(piece_index, begin, length - 9)
+                if self.block_view is not None: 
+                    break # the rest of the block is received into the piece buffer 
+                continue 
+            if available < 4 + length: 
+                break 
+            self.recv_start = start + 4 + length 
+            self._process_message(bytes(self.recv_view[start + 4:start + 4 + length]))
+        if self.recv_start == self.recv_end: 
+            self.recv_start = self.recv_end = 0 
+
+    def _receive_handshake(self, response): 
+        # validate the peer's handshake before any message is parsed 
+        ok = response[0] == 19 and response[28:48] == self.torrent.info_hash 
+        if ok: 
+            self.handshake = True 
+            self.running = True 
+            # we always set both bits, so the peer's bits alone decide 
+            byte, mask = self.RESERVED_FAST 
+            self.supports_fast = bool(response[20 + byte] & mask)
+            byte, mask = self.RESERVED_EXTENDED 
+            self.supports_extended = bool(response[20 + byte] & mask)
+        if self.handshake_done and not self.handshake_done.done(): 
+            self.handshake_done.set_result(ok)
+        if not ok: 
+            self.close()
+        return ok 
+
+    def _start_block(self, piece_index, begin, length): 
+        # point the receive path at the block's slot in its piece buffer 
+        view = None 
+        if self.on_block_buffer: 
+            view = self.on_block_buffer(self, piece_index, begin, length)
+        if view is None: 
+            # nobody needs this block any more, receive it into a throwaway buffer 
+            view = memoryview(bytearray(length))
+        self.block_key = (piece_index, begin)
+        self.block_view = view 
+        # the start of the payload may already be sitting in scratch 
+        taken = min(length, self.recv_end - self.recv_start)
+        if taken: 
+            view[:taken] = self.recv_view[self.recv_start:self.recv_start + taken]
+            self.recv_start += taken 
+        self.block_filled = taken 
+        if taken == length: 
+            self._finish_block()
+
+    def detach_block(self, piece_index, begin): 
+        # another copy of the block being received won, the rest of this one 
+        # goes to a throwaway buffer instead of over the piece 
+        if self.block_view is not None and self.block_key == (piece_index, begin): 
+            self.block_view = memoryview(bytearray(len(self.block_view)))
+
+    def _finish_block(self): 
+        piece_index, begin = self.block_key 
+        length = len(self.block_view)
+        self.block_view = None 
+        self.block_key = None 
+        self._handle_piece_message(piece_index, begin, length)
+
+    async def _write_loop(self): 
+        # send queued messages to the peer, respecting transport backpressure 
         try: 
-            while self.running and self.connected:
-                #read message length
-                length_data = self._recv_exact(4)
-                if not length_data:
+            while self.connected: 
+                await self.write_ready.wait()
+                if not self.connected: 
                     break 
-                length = struct.unpack('!I', length_data)[0] 
-                if length ==0: #keep message alive 
-                    continue
-                #read message 
-                message_data = self._recv_exact(length)
-                if not message_data:
-                    break
-                self._process_message(message_data)
+                if self.send_queue: 
+                    # everything queued goes out in a single write 
+                    messages = b''.join(self.send_queue)
+                    self.send_queue.clear()
+                    self.transport.write(messages)
+                elif self.upload_queue and (not self.am_chocking or self.granted_fast): 
+                    request, _ = self.upload_queue.popitem(last=False)
+                    if self.on_upload: 
+                        await self.on_upload(self, *request)
+                        self.uploaded += request[2]
+                        if self.upload_buckets: 
+                            await self._throttle_upload(request[2])
+                else: 
+                    self.send_wakeup.clear()
+                    await self.send_wakeup.wait()
+        except asyncio.CancelledError: 
+            pass
         except Exception as e: 
-            print(f"Message handling error for {self.ip}:{self.port}: {e}")
-        finally:
+            log.info("Failed to send to %s:%s: %s", self.ip, self.port, e)
+        finally: 
             self.close()
     
-    def _recv_exact(self,length):
-        # receive exact length bytes 
-        data = b''
-        while len(data)< length: 
-            chunk = self.socket.recv(length -len(data))
-            if not chunk: 
-                return None
-            data += chunk
-        return data 
-    
     def _process_message(self,data): 
         #process a received message 
         message_id = data[0]
         payload = data[1:]
         if message_id == self.CHOKE: 
             self.peer_choking = True 
-            print(f"Peer {self.ip}: {self.port} chocked us ")
+            # a choking peer discards every request we have queued with it, 
+            # with the fast extension it rejects them one by one instead 
+            if not self.supports_fast: 
+                self._drop_requests()
+            log.debug("Peer %s:%s choked us", self.ip, self.port)
         elif message_id == self.UNCHOKE: 
             self.peer_choking = False 
-            print(f"Peer {self.ip}: {self.port} unchocked us")
+            log.debug("Peer %s:%s unchoked us", self.ip, self.port)
+            # request right away rather than on the client's next tick 
+            if self.on_unchoke: 
+                self.on_unchoke(self)
         elif message_id == self.INTERESTED: 
             self.peer_interested = True 
         elif message_id == self.NOT_INTERESTED: 
             self.peer_interested = False 
         elif message_id == self.HAVE: 
             pieces_index = struct.unpack("!I", payload )[0]
-            self.peer_pieces.add(pieces_index)
+            if pieces_index < self.torrent.num_pieces and self.peer_pieces.add(pieces_index): 
+                if self.on_have: 
+                    self.on_have(self, pieces_index)
         elif message_id == self.BITFIELD:
             self._parse_bitfield(payload)
-        elif message_id == self.PIECE:
-            self._handle_piece_message(payload)
+        elif message_id == self.REQUEST and len(payload) == 12: 
+            # requests from a choked peer are dropped, as are requests we 
+            # can't serve 
+            request = struct.unpack('!III', payload)
+            if self.am_chocking and request[0] not in self.granted_fast: 
+                self._reject(request)
+            elif len(self.upload_queue) >= self.MAX_UPLOAD_QUEUE or not 0 < request[2] <= self.MAX_REQUEST_LENGTH: 
+                self._reject(request)
+            elif self.on_request and self.on_request(self, *request): 
+                self.upload_queue[request] = None 
+                self.send_wakeup.set()
+            else: 
+                self._reject(request)
+        elif message_id == self.CANCEL and len(payload) == 12: 
+            request = struct.unpack('!III', payload)
+            # with the fast extension every request is answered, a cancelled 
+            # one with a reject 
+            if request in self.upload_queue: 
+                del self.upload_queue[request]
+                self._reject(request)
+        elif message_id in (self.HAVE_ALL, self.HAVE_NONE, self.REJECT_REQUEST, self.ALLOWED_FAST, self.SUGGEST_PIECE): 
+            if not self.supports_fast: 
+                log.info("Fast extension message from %s:%s without negotiating it", self.ip, self.port)
+                self.close()
+                return 
+            self._process_fast_message(message_id, payload)
+        elif message_id == self.EXTENDED and payload and self.supports_extended: 
+            self._process_extended_message(payload[0], payload[1:])
+
+    def _process_fast_message(self, message_id, payload): 
+        if message_id == self.HAVE_ALL: 
+            self._set_peer_pieces(Bitfield.from_bytes(b'\xff' * len(self.peer_pieces.bits), self.torrent.num_pieces))
+        elif message_id == self.HAVE_NONE: 
+            self._set_peer_pieces(Bitfield(self.torrent.num_pieces))
+        elif message_id == self.REJECT_REQUEST and len(payload) == 12: 
+            # a dropped request is handed back at once instead of timing out 
+            piece_index, begin, length = struct.unpack('!III', payload)
+            request_key = (piece_index, begin)
+            if self.pending_request.pop(request_key, None) is not None: 
+                if self.rtt_probe == request_key: 
+                    self.rtt_probe = None 
+                if self.on_requests_dropped: 
+                    self.on_requests_dropped(self, [request_key])
+        elif message_id == self.ALLOWED_FAST and len(payload) == 4: 
+            piece_index = struct.unpack('!I', payload)[0]
+            if piece_index < self.torrent.num_pieces: 
+                self.allowed_fast.add(piece_index)
+                if self.peer_choking and self.on_unchoke: 
+                    self.on_unchoke(self)
+        # SUGGEST_PIECE is only a hint, the picker knows better 
+
+    def _process_extended_message(self, extended_id, payload): 
+        if extended_id != self.EXTENDED_HANDSHAKE: 
+            return # no extension messages are registered in our handshake 
+        try: 
+            handshake = Bencode.decode(payload)
+        except (ValueError, IndexError, TypeError): 
+            log.info("Bad extended handshake from %s:%s", self.ip, self.port)
+            return 
+        if not isinstance(handshake, dict): 
+            return 
+        if isinstance(handshake.get('m'), dict): 
+            self.extensions = handshake['m']
+        if isinstance(handshake.get('v'), bytes): 
+            self.client_name = handshake['v'].decode('utf-8', 'replace')
+        reqq = handshake.get('reqq')
+        if isinstance(reqq, int) and reqq > 0: 
+            # requests past the peer's queue limit would be dropped unanswered 
+            self.max_requests = reqq 
+            self._update_queue_depth()
+        log.debug("Extended handshake from %s:%s: client %s, reqq %s", self.ip, self.port, self.client_name, reqq)
+
+    def _reject(self, request): 
+        # peers without the fast extension just never get an answer 
+        if self.supports_fast: 
+            self.send_message(self.REJECT_REQUEST, struct.pack('!III', *request))
     
     def _parse_bitfield(self, bitfield): 
         # parse bitfield message to determine the peer's piece 
-        for bytes_index , byte in enumerate(bitfield):
-            for bit_index in range(8): 
-                piece_index = bytes_index * 8 + bit_index
-                if piece_index >= self.torrent.num_pieces: 
-                    break 
-                if byte & (0x80 >> bit_index): 
-                    self.peer_pieces.add(piece_index)
-            print(f"Peer {self.ip}:{self.port} has {len(self.peer_pieces)} pieces")
+        self._set_peer_pieces(Bitfield.from_bytes(bitfield, self.torrent.num_pieces))
+        log.debug("Peer %s:%s has %d pieces", self.ip, self.port, len(self.peer_pieces))
+
+    def _set_peer_pieces(self, pieces): 
+        # a BITFIELD, HAVE_ALL or HAVE_NONE replaces whatever the peer announced 
+        # before, the client takes the old set out of the availability counts 
+        old = self.peer_pieces 
+        self.peer_pieces = pieces 
+        if self.on_bitfield: 
+            self.on_bitfield(self, old)
     
-    def _handle_piece_message(self, payload): 
-        # handle received piece data 
-        piece_index, begin = struct.unpack('!II', payload[:8])
-        block_data = payload[8:]
+    def _handle_piece_message(self, piece_index, begin, length): 
+        # a block has been received in full 
         request_key = (piece_index, begin)
-        
-        if request_key in self.pending_request: 
-            print(f"Received block {piece_index}:{begin} from {self.ip}:{self.port}")
+        now = time.monotonic()
+        self.last_block_at = now 
+
+        # late blocks for timed out requests are still handed to the client 
+        sent_at = self.pending_request.pop(request_key, None)
+        if request_key == self.rtt_probe: 
+            if sent_at is not None: 
+                self._sample_rtt(now - sent_at)
+            self.rtt_probe = None
+        log.debug("Received block %d:%d from %s:%s", piece_index, begin, self.ip, self.port)
+
+        self.rate_bytes += length 
+        self.downloaded += length 
+        self.update_rate(now)
+        if self.on_block: 
+            self.on_block(self, piece_index, begin, length)
+
+    def _sample_rtt(self, sample): 
+        # smoothed round trip time, only sampled while the pipe is empty so 
+        # it never includes time spent queued behind our own requests 
+        REQUEST_RTT.observe(sample)
+        if self.rtt is None: 
+            self.rtt = sample 
+        else: 
+            self.rtt = 0.875 * self.rtt + 0.125 * sample 
+
+    def update_rate(self, now = None): 
+        # fold the bytes received in the last interval into the rate estimate 
+        now = now or time.monotonic()
+        elapsed = now - self.rate_start 
+        if elapsed < self.RATE_INTERVAL: 
+            return 
+        sample = self.rate_bytes / elapsed 
+        self.download_rate = 0.6 * self.download_rate + 0.4 * sample if self.download_rate else sample 
+        self.rate_bytes = 0 
+        self.rate_start = now 
+        self._update_queue_depth()
+
+    def _update_queue_depth(self): 
+        # keep two round trips plus QUEUE_TIME worth of blocks outstanding; 
+        # while the queue limits throughput this doubles the depth each interval 
+        rtt = self.rtt or 0 
+        depth = math.ceil(self.download_rate * (2 * rtt + self.QUEUE_TIME) / self.BLOCK_SIZE)
+        self.target_queue = max(self.MIN_QUEUE, min(self.MAX_QUEUE, depth))
+        if self.max_requests: 
+            self.target_queue = min(self.target_queue, self.max_requests)
+
+    def request_timeout(self): 
+        # how long the peer may go without delivering a block while we 
+        # have requests outstanding with it 
+        if not self.download_rate: 
+            return self.MAX_REQUEST_TIMEOUT 
+        expected = 2 * ((self.rtt or 0) + self.BLOCK_SIZE / self.download_rate)
+        return max(self.MIN_REQUEST_TIMEOUT, min(self.MAX_REQUEST_TIMEOUT, expected))
+
+    def expire_requests(self, now = None): 
+        # forget requests that are overdue and return their keys so the 
+        # client can re-issue them to other peers 
+        if not self.pending_request: 
+            return []
+        now = now or time.monotonic()
+        oldest = next(iter(self.pending_request.values()))
+        if now - max(oldest, self.last_block_at) > self.request_timeout(): 
+            # the peer stalled, nothing outstanding is coming back soon 
+            expired = list(self.pending_request)
+        else: 
+            # requests passed over while newer ones are answered were dropped 
+            expired = []
+            for request_key, sent_at in self.pending_request.items(): 
+                if now - sent_at <= self.MAX_REQUEST_TIMEOUT: 
+                    break # requests are kept in the order they were sent 
+                expired.append(request_key)
+        for request_key in expired: 
             del self.pending_request[request_key]
-            
-            # Store the block data
-            if piece_index not in self.piece_blocks:
-                self.piece_blocks[piece_index] = {}
-            self.piece_blocks[piece_index][begin] = block_data
-            
-            # Check if piece is complete
-            piece_size = self.torrent.get_pieces_size(piece_index)
-            received_size = sum(len(data) for data in self.piece_blocks[piece_index].values())
-            
-            if received_size >= piece_size:
-                self._complete_piece(piece_index)
+        if expired: 
+            self.target_queue = max(self.MIN_QUEUE, self.target_queue // 2)
+            log.debug("%d requests to %s:%s timed out", len(expired), self.ip, self.port)
+        return expired 
+
+    def _drop_requests(self): 
+        # hand every outstanding request back to the client 
+        dropped = list(self.pending_request)
+        self.pending_request.clear()
+        self.rtt_probe = None 
+        if dropped and self.on_requests_dropped: 
+            self.on_requests_dropped(self, dropped)
 
     def send_message(self,message_id, payload = b''):
         #send message to peer 
@@ -171,68 +633,135 @@ class PeerConnection:
         try: 
             length = len(payload) + 1 
             message = struct.pack('!IB', length, message_id) + payload 
-            self.socket.send(message)
+            self.send_queue.append(message)
+            self.send_wakeup.set()
             return True 
         except Exception as e: 
-            print(f"Failed to send message {self.ip}: {self.port}:{e}")
+            log.info("Failed to send message to %s:%s: %s", self.ip, self.port, e)
             return False 
-    
-    def _complete_piece(self, piece_index):
-        """Assemble and verify a complete piece"""
-        # Sort blocks by offset and concatenate
-        sorted_blocks = sorted(self.piece_blocks[piece_index].items())
-        piece_data = b''.join(data for offset, data in sorted_blocks)
-        
-        # Verify hash
-        import hashlib
-        expected_hash = self.torrent.pieces_hash[piece_index]
-        actual_hash = hashlib.sha1(piece_data).digest()
-        
-        if expected_hash == actual_hash:
-            print(f"Piece {piece_index} completed and verified")
-            # TODO: Signal to client that piece is complete
-            # You'll need to add a callback mechanism here
-        else:
-            print(f"Piece {piece_index} hash verification failed")
-        
-        # Clean up
-        del self.piece_blocks[piece_index]
 
     def send_interested(self): 
         # send interested message 
         if self.send_message(self.INTERESTED) : 
             self.am_interested = True 
-            print(f"send interest to {self.ip}: {self.port}")
+            log.debug("Sent interested to %s:%s", self.ip, self.port)
     
     def send_not_interested(self): 
         #send non interested message 
         if self.send_message(self.NOT_INTERESTED): 
             self.am_interested = False
+
+    def send_choke(self): 
+        # the peer's queued requests are discarded, it re-requests after an unchoke. 
+        # a fast extension peer is told which ones and keeps its allowed fast pieces 
+        if self.send_message(self.CHOKE): 
+            self.am_chocking = True 
+            for request in list(self.upload_queue): 
+                if request[0] not in self.granted_fast: 
+                    del self.upload_queue[request]
+                    self._reject(request)
+
+    def send_unchoke(self): 
+        if self.send_message(self.UNCHOKE): 
+            self.am_chocking = False 
+
+    def send_have(self, piece_index): 
+        self.send_message(self.HAVE, struct.pack('!I', piece_index))
+
+    def send_bitfield(self, bitfield): 
+        # only valid as the first message after the handshake 
+        self.send_message(self.BITFIELD, bitfield)
+
+    def send_have_all(self): 
+        self.send_message(self.HAVE_ALL)
+
+    def send_have_none(self): 
+        self.send_message(self.HAVE_NONE)
+
+    def send_allowed_fast(self, piece_index): 
+        if self.send_message(self.ALLOWED_FAST, struct.pack('!I', piece_index)): 
+            self.granted_fast.add(piece_index)
+
+    def send_extended_handshake(self, port = None): 
+        # we register no extension messages, the handshake tells the peer our 
+        # listen port and how many requests we queue 
+        handshake = {'m': {}, 'v': self.CLIENT_NAME, 'reqq': self.MAX_UPLOAD_QUEUE}
+        if port: 
+            handshake['p'] = port 
+        self.send_message(self.EXTENDED, bytes([self.EXTENDED_HANDSHAKE]) + Bencode.encode(handshake))
+
+    def can_request(self, piece_index): 
+        # the peer has the piece and will serve it to us right now 
+        return piece_index in self.peer_pieces and (not self.peer_choking or piece_index in self.allowed_fast)
          
     def request_piece(self,piece_index, begin, length): 
         # request a piece block from peer 
-        if self.peer_choking or not self.handshake: 
+        if (self.peer_choking and piece_index not in self.allowed_fast) or not self.handshake: 
             return False 
         payload = struct.pack('!III', piece_index, begin,length)
         if self.send_message(self.REQUEST, payload): 
-            self.pending_request[(piece_index,begin)] = time.time()
-            print(f"Requested piece {piece_index}:{begin} from {self.ip}:{self.port}")
+            if not self.pending_request: 
+                self.rtt_probe = (piece_index, begin)
+            self.pending_request[(piece_index,begin)] = time.monotonic()
+            log.debug("Requested block %d:%d from %s:%s", piece_index, begin, self.ip, self.port)
             return True
         return False 
     
+    def cancel_request(self, piece_index, begin, length): 
+        # withdraw a request that is still outstanding with this peer 
+        request_key = (piece_index, begin)
+        if self.pending_request.pop(request_key, None) is None: 
+            return False 
+        if self.rtt_probe == request_key: 
+            self.rtt_probe = None 
+        return self.send_message(self.CANCEL, struct.pack('!III', piece_index, begin, length))
+
     def has_piece(self,piece_index): 
         #check if peer has specific piece 
         return piece_index in self.peer_pieces
     
     def close(self): 
         #close connections 
+        was_connected = self.connected 
         self.running = False 
-        if self.socket: 
+        self.connected = False 
+        if self.transport: 
             try: 
-                self.socket.close() 
+                self.transport.close() 
             except: 
                 pass
-        self.connected = False 
-        print(f"Closed connection to {self.ip}: {self.port}")
+        if self.writer_task and self.writer_task is not asyncio.current_task(): 
+            self.writer_task.cancel()
+        if self.handshake_done and not self.handshake_done.done(): 
+            self.handshake_done.set_result(False)
+        self.block_view = None 
+        self.upload_queue.clear()
+        if self.resume_handle: 
+            self.resume_handle.cancel()
+            self.resume_handle = None 
+        self._drop_requests()
+        if was_connected: 
+            if self.on_close: 
+                self.on_close(self)
+            log.info("Closed connection to %s:%s", self.ip, self.port)
 
 
+def allowed_fast_set(ip, info_hash, num_pieces, count = PeerConnection.ALLOWED_FAST_COUNT): 
+    """The BEP 6 allowed fast pieces of a peer, derived from its IPv4 /24 
+    and the info hash so every peer in the swarm gets the same set from us"""
+    try: 
+        address = ipaddress.ip_address(ip)
+    except ValueError: 
+        return []
+    if address.version != 4: 
+        return []
+    x = (int(address) & 0xffffff00).to_bytes(4, 'big') + info_hash 
+    count = min(count, num_pieces)
+    pieces = []
+    while len(pieces) < count: 
+        x = hashlib.sha1(x).digest()
+        for position in range(0, 20, 4): 
+            piece_index = int.from_bytes(x[position:position + 4], 'big') % num_pieces 
+            if len(pieces) < count and piece_index not in pieces: 
+                pieces.append(piece_index)
+    return pieces 
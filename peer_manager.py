@@ -0,0 +1,128 @@
+import math
+import time
+
+
+class Candidate:
+    """What we know about a peer address, connected or not"""
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.failures = 0
+        self.hash_failures = 0.0
+        self.rate = 0.0
+        self.last_attempt = None
+        self.retry_at = 0.0
+        # peers that connected to us, their source port can't be dialed
+        self.incoming = False
+
+    def score(self):
+        # past throughput earns priority, failed dials and corrupt data cost it
+        return math.log2(1 + self.rate / 1024) - 2 * self.failures - 4 * self.hash_failures
+
+
+class PeerManager:
+    """Scored candidate list deciding which peers to dial and which to drop"""
+
+    MAX_CANDIDATES = 2000
+    MAX_FAILURES = 5 # consecutive failed dials before a candidate is forgotten
+    RETRY_DELAY = 30 # doubled with every consecutive failure
+    RECONNECT_DELAY = 60 # before redialing a peer that disconnected
+    SNUB_TIMEOUT = 60 # seconds without data either way before a peer is dropped
+
+    def __init__(self, target_peers = 50, max_half_open = 8, max_hash_failures = 3):
+        self.target_peers = target_peers
+        self.max_half_open = max_half_open
+        self.max_hash_failures = max_hash_failures
+        self.candidates = {}
+        self.banned = set()
+
+    def add_candidates(self, peers):
+        for ip, port in peers:
+            peer_key = f"{ip}:{port}"
+            if peer_key not in self.candidates and peer_key not in self.banned and port:
+                self.candidates[peer_key] = Candidate(ip, port)
+        if len(self.candidates) > self.MAX_CANDIDATES:
+            ranked = sorted(self.candidates.items(), key=lambda item: item[1].score(), reverse=True)
+            self.candidates = dict(ranked[:self.MAX_CANDIDATES])
+
+    def pick(self, count, busy, now = None):
+        """Up to count (peer key, candidate) pairs to dial, best first, skipping
+        peers in busy and those still backing off"""
+        if count <= 0:
+            return []
+        now = now or time.monotonic()
+        eligible = [(peer_key, candidate) for peer_key, candidate in self.candidates.items()
+                    if peer_key not in busy and candidate.retry_at <= now and not candidate.incoming]
+        eligible.sort(key=lambda item: item[1].score(), reverse=True)
+        picked = eligible[:count]
+        for _, candidate in picked:
+            candidate.last_attempt = now
+        return picked
+
+    def waiting(self, busy, now = None):
+        # whether a dial could be made right now
+        now = now or time.monotonic()
+        return any(peer_key not in busy and candidate.retry_at <= now and not candidate.incoming
+                   for peer_key, candidate in self.candidates.items())
+
+    def connect_failed(self, peer_key, now = None):
+        candidate = self.candidates.get(peer_key)
+        if candidate is None:
+            return
+        candidate.failures += 1
+        if candidate.failures >= self.MAX_FAILURES:
+            del self.candidates[peer_key]
+        else:
+            candidate.retry_at = (now or time.monotonic()) + self.RETRY_DELAY * 2 ** (candidate.failures - 1)
+
+    def connected(self, peer_key, ip, port, incoming = False):
+        candidate = self.candidates.get(peer_key)
+        if candidate is None:
+            # incoming connections are tracked for their hash failures
+            candidate = self.candidates[peer_key] = Candidate(ip, port)
+            candidate.incoming = incoming
+        candidate.failures = 0
+
+    def disconnected(self, peer_key, peer, now = None):
+        # remember how useful the connection was for the next time it is scored
+        candidate = self.candidates.get(peer_key)
+        if candidate is None:
+            return
+        if candidate.incoming:
+            del self.candidates[peer_key]
+            return
+        now = now or time.monotonic()
+        elapsed = now - peer.connected_at if peer.connected_at else 0
+        if elapsed > 0:
+            rate = (peer.downloaded + peer.uploaded) / elapsed
+            candidate.rate = max(rate, 0.5 * candidate.rate)
+        candidate.retry_at = now + self.RECONNECT_DELAY
+
+    def hash_failure(self, peer_key, share):
+        """Count a share of a corrupt piece against a peer, True once it is banned"""
+        candidate = self.candidates.get(peer_key)
+        if candidate is None or peer_key in self.banned:
+            return False
+        candidate.hash_failures += share
+        if candidate.hash_failures >= self.max_hash_failures:
+            self.banned.add(peer_key)
+            del self.candidates[peer_key]
+            return True
+        return False
+
+    def is_banned(self, peer_key):
+        return peer_key in self.banned
+
+    def is_useless(self, peer, seeding, now = None):
+        """True for peers that moved no data either way for SNUB_TIMEOUT"""
+        now = now or time.monotonic()
+        if not peer.connected:
+            return True
+        if not peer.am_chocking and peer.peer_interested:
+            return False # we are uploading to it
+        if now - peer.connected_at < self.SNUB_TIMEOUT:
+            return False
+        if seeding:
+            return not peer.peer_interested
+        return now - peer.last_block_at > self.SNUB_TIMEOUT
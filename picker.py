@@ -0,0 +1,171 @@
+import heapq
+import random
+from array import array
+from bitfield import Bitfield
+
+
+class PiecePicker:
+    """Choose the next piece to download from per-piece availability counts"""
+
+    RAREST_FIRST = 'rarest-first'
+    RANDOM_FIRST = 'random-first'
+    SEQUENTIAL = 'sequential'
+
+    # heap entries a pick passes over for a peer lacking them, or a sixteenth
+    # of the peer's wanted pieces if more, before it ranks those directly
+    SCAN_LIMIT = 64
+
+    def __init__(self, num_pieces, policy = RAREST_FIRST, random_pieces = 4):
+        self.num_pieces = num_pieces
+        self.policy = policy
+        # RANDOM_FIRST picks this many pieces at random before going rarest first
+        self.random_pieces = random_pieces
+
+        # how many connected peers have each piece
+        self.availability = array('I', [0]) * num_pieces
+        # random tie breaker so equally rare pieces are spread across the swarm
+        self.rank = list(range(num_pieces))
+        random.shuffle(self.rank)
+
+        # pieces nobody has started yet, and a heap over the available ones
+        self.wanted = Bitfield.from_bytes(b'\xff' * ((num_pieces + 7) // 8), num_pieces)
+        self.completed = 0
+        self.heap = []
+        self._random_phase = policy == self.RANDOM_FIRST
+        # streaming: piece -> deadline, these go before any policy, soonest first
+        self.deadlines = {}
+
+    def set_policy(self, policy):
+        self.policy = policy
+        self._random_phase = policy == self.RANDOM_FIRST and self.completed < self.random_pieces
+        self._rebuild()
+
+    def _key(self, piece_index):
+        if self.policy == self.SEQUENTIAL:
+            return (0, piece_index)
+        if self._random_phase:
+            return (0, self.rank[piece_index])
+        return (self.availability[piece_index], self.rank[piece_index])
+
+    def _push(self, piece_index):
+        # heap entries are never updated in place, a changed piece gets a new
+        # entry and the old one is skipped as stale when it surfaces
+        if piece_index in self.wanted and self.availability[piece_index]:
+            heapq.heappush(self.heap, self._key(piece_index) + (piece_index,))
+            if len(self.heap) > 2 * len(self.wanted) + 64:
+                self._rebuild()
+
+    def _rebuild(self):
+        self.heap = [self._key(i) + (i,) for i in self.wanted if self.availability[i]]
+        heapq.heapify(self.heap)
+
+    def _is_current(self, entry):
+        piece_index = entry[-1]
+        return (piece_index in self.wanted and self.availability[piece_index]
+                and entry[:-1] == self._key(piece_index))
+
+    # availability updates
+
+    def add_peer(self, pieces):
+        # a peer's bitfield arrived
+        availability = self.availability
+        for piece_index in pieces:
+            availability[piece_index] += 1
+        self._changed(pieces)
+
+    def peer_has(self, piece_index):
+        self.availability[piece_index] += 1
+        self._push(piece_index)
+
+    def remove_peer(self, pieces):
+        # a peer disconnected, its pieces are no longer available from it
+        availability = self.availability
+        for piece_index in pieces:
+            if availability[piece_index]:
+                availability[piece_index] -= 1
+        self._changed(pieces)
+
+    def _changed(self, pieces):
+        # a bulk change is cheaper to absorb with one O(n) heapify
+        if len(pieces) > len(self.heap) // 8:
+            self._rebuild()
+        else:
+            for piece_index in pieces:
+                self._push(piece_index)
+
+    def set_deadlines(self, deadlines):
+        # replaces every deadline, a read window that moved drops the old ones
+        self.deadlines = dict(deadlines)
+
+    # piece life cycle
+
+    def pick(self, has_piece, pieces = None):
+        """Return the best wanted piece for which has_piece() is true, or None.
+
+        pieces is the peer's Bitfield. With it a peer that has none of the
+        wanted pieces costs one bitmap AND, and one that has only a few is
+        answered from those instead of walking the heap past everything else.
+        """
+        if self.deadlines:
+            deadlines = self.deadlines
+            for piece_index in sorted(deadlines, key=lambda piece_index: (deadlines[piece_index], piece_index)):
+                if piece_index in self.wanted and has_piece(piece_index):
+                    self.wanted.discard(piece_index)
+                    return piece_index
+        skipped = []
+        picked = None
+        candidates = None
+        heap = self.heap
+        while heap:
+            entry = heap[0]
+            if not self._is_current(entry):
+                heapq.heappop(heap)
+                continue
+            if has_piece(entry[-1]):
+                heapq.heappop(heap)
+                picked = entry[-1]
+                break
+            if pieces is not None:
+                # the peer lacks the best piece, see what it does have first
+                if candidates is None:
+                    candidates = pieces & self.wanted
+                if not candidates or len(skipped) >= max(self.SCAN_LIMIT, len(candidates) >> 4):
+                    break
+            skipped.append(heapq.heappop(heap))
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        if picked is None and candidates is not None:
+            return self._pick_from(candidates, has_piece)
+        if picked is not None:
+            self.wanted.discard(picked)
+        return picked
+
+    def pick_from(self, pieces, has_piece):
+        """Like pick() but only among pieces, e.g. the few a choking peer
+        allows fast, at a cost that grows with them rather than the torrent"""
+        return self._pick_from([piece_index for piece_index in pieces if piece_index in self.wanted], has_piece)
+
+    def _pick_from(self, candidates, has_piece):
+        # best of a peer's wanted pieces by the same key the heap orders by
+        best = min((self._key(piece_index) + (piece_index,) for piece_index in candidates
+                    if self.availability[piece_index] and has_piece(piece_index)), default=None)
+        if best is None:
+            return None
+        self.wanted.discard(best[-1])
+        return best[-1]
+
+    def piece_started(self, piece_index):
+        self.wanted.discard(piece_index)
+
+    def piece_failed(self, piece_index):
+        # an aborted or corrupt piece goes back into the pool
+        self.wanted.add(piece_index)
+        self._push(piece_index)
+
+    def piece_completed(self, piece_index):
+        self.wanted.discard(piece_index)
+        self.deadlines.pop(piece_index, None)
+        self.completed += 1
+        if self._random_phase and self.completed >= self.random_pieces:
+            self._random_phase = False
+            self._rebuild()
@@ -0,0 +1,103 @@
+class PieceState:
+    """Block bookkeeping of one piece being downloaded, shared by every peer
+    working on it.
+
+    One byte per block holds its state, so finding the next block to request
+    is a bytearray scan in C and completion is a counter check. Blocks are
+    received straight into buffer, which is hashed and written out as is.
+    Only one peer at a time may receive a block into buffer, every other copy
+    goes to a buffer of its own and is copied in if it arrives first.
+    """
+
+    FREE = 0
+    REQUESTED = 1
+    RECEIVED = 2
+
+    __slots__ = ('index', 'size', 'block_size', 'buffer', 'states', 'received', 'next_free', 'peers', 'writers')
+
+    def __init__(self, index, size, block_size = 16384):
+        self.index = index
+        self.size = size
+        self.block_size = block_size
+        self.buffer = bytearray(size)
+        self.states = bytearray((size + block_size - 1) // block_size)
+        self.received = 0
+        # no block before this one is free
+        self.next_free = 0
+        # peers that sent blocks of it, blamed if the hash fails
+        self.peers = set()
+        # block -> the peer receiving it straight into buffer right now
+        self.writers = {}
+
+    def __len__(self):
+        return len(self.states)
+
+    def block_length(self, block):
+        return min(self.block_size, self.size - block * self.block_size)
+
+    def block_at(self, begin, length):
+        """Block index for a block-aligned (begin, length), None otherwise"""
+        block, offset = divmod(begin, self.block_size)
+        if offset or block >= len(self.states) or length != self.block_length(block):
+            return None
+        return block
+
+    def free_block(self, start = 0):
+        # first block at or after start nobody has been asked for, or None
+        start = max(start, self.next_free)
+        block = self.states.find(self.FREE, start)
+        if block < 0:
+            if start == self.next_free:
+                self.next_free = len(self.states)
+            return None
+        if start == self.next_free:
+            self.next_free = block
+        return block
+
+    def has_free(self):
+        return self.free_block() is not None
+
+    def request(self, block):
+        if self.states[block] == self.FREE:
+            self.states[block] = self.REQUESTED
+
+    def release(self, block):
+        # a request that won't be answered, the block can be asked for again
+        if self.states[block] == self.REQUESTED:
+            self.states[block] = self.FREE
+            if block < self.next_free:
+                self.next_free = block
+
+    def claim(self, block, peer):
+        """Let peer receive a block straight into buffer, False while another
+        peer is doing so"""
+        writer = self.writers.get(block)
+        if writer is not None and writer is not peer:
+            return False
+        self.writers[block] = peer
+        return True
+
+    def unclaim(self, block, peer):
+        # the peer went away in the middle of the block
+        if self.writers.get(block) is peer:
+            del self.writers[block]
+
+    def receive(self, block, peer = None):
+        """Mark a block received, False if it already was"""
+        if self.states[block] == self.RECEIVED:
+            return False
+        self.states[block] = self.RECEIVED
+        self.received += 1
+        if peer is not None:
+            self.peers.add(peer)
+        return True
+
+    def is_received(self, block):
+        return self.states[block] == self.RECEIVED
+
+    def complete(self):
+        return self.received == len(self.states)
+
+    def missing(self):
+        # blocks not received yet, requested or not
+        return [block for block, state in enumerate(self.states) if state != self.RECEIVED]
@@ -0,0 +1,94 @@
+import time
+
+
+class TokenBucket:
+    """Byte rate limit with a short burst allowance, a rate of 0 is unlimited.
+
+    Transfers are charged after the fact and may leave the bucket in debt;
+    the caller waits out the returned delay before moving more data, so the
+    long run average stays at the rate whatever the transfer sizes.
+    """
+
+    BURST = 0.1 # seconds of traffic that may go out back to back
+    MIN_BURST = 16384
+
+    def __init__(self, rate = 0):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate:
+            capacity = max(self.rate * self.BURST, self.MIN_BURST)
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, capacity)
+        self.last = now
+
+    def set_rate(self, rate):
+        self._refill(time.monotonic())
+        self.rate = rate
+        if not rate:
+            self.tokens = 0.0
+
+    def consume(self, nbytes, now = None):
+        """Charge nbytes, return seconds to wait before the next transfer"""
+        if not self.rate:
+            return 0.0
+        self._refill(now or time.monotonic())
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def delay(self, now = None):
+        if not self.rate:
+            return 0.0
+        self._refill(now or time.monotonic())
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimiter:
+    """Upload and download limits at three levels: the whole process, each
+    torrent and each peer. A peer's traffic is charged to all three and it
+    waits for whichever is furthest in debt. Rates are bytes per second and
+    can be changed at any time."""
+
+    def __init__(self, upload_rate = 0, download_rate = 0, peer_upload_rate = 0, peer_download_rate = 0):
+        self.upload = TokenBucket(upload_rate)
+        self.download = TokenBucket(download_rate)
+        # defaults for peers attached from now on
+        self.peer_upload_rate = peer_upload_rate
+        self.peer_download_rate = peer_download_rate
+        # info_hash -> (upload, download) buckets
+        self.torrents = {}
+
+    def _torrent(self, info_hash):
+        buckets = self.torrents.get(info_hash)
+        if buckets is None:
+            buckets = self.torrents[info_hash] = (TokenBucket(), TokenBucket())
+        return buckets
+
+    def set_global(self, upload_rate = None, download_rate = None):
+        if upload_rate is not None:
+            self.upload.set_rate(upload_rate)
+        if download_rate is not None:
+            self.download.set_rate(download_rate)
+
+    def set_torrent(self, info_hash, upload_rate = None, download_rate = None):
+        upload, download = self._torrent(info_hash)
+        if upload_rate is not None:
+            upload.set_rate(upload_rate)
+        if download_rate is not None:
+            download.set_rate(download_rate)
+
+    def set_peer(self, peer, upload_rate = None, download_rate = None):
+        if upload_rate is not None:
+            peer.upload_buckets[0].set_rate(upload_rate)
+        if download_rate is not None:
+            peer.download_buckets[0].set_rate(download_rate)
+
+    def remove_torrent(self, info_hash):
+        self.torrents.pop(info_hash, None)
+
+    def attach(self, peer, info_hash):
+        # give a new peer its own buckets, chained to its torrent's and the global ones
+        upload, download = self._torrent(info_hash)
+        peer.upload_buckets = (TokenBucket(self.peer_upload_rate), upload, self.upload)
+        peer.download_buckets = (TokenBucket(self.peer_download_rate), download, self.download)
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import time
+from bencode import Bencode
+from bitfield import Bitfield
+
+
+class ResumeData:
+    """Completed-piece bitmap persisted next to the download, with the file
+    sizes and mtimes it is valid for"""
+
+    def __init__(self, torrent, storage, path = None):
+        self.torrent = torrent
+        self.storage = storage
+        self.path = path or os.path.join(storage.base_dir, f".{torrent.info_hash.hex()}.resume")
+
+    def load(self):
+        """Return the completed pieces if no file changed since the last save, else None"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = Bencode.decode(f.read())
+            if data['info hash'] != self.torrent.info_hash:
+                return None
+            saved_stats = [tuple(stat) if stat else None for stat in data['files']]
+        except (OSError, ValueError, KeyError, TypeError, IndexError):
+            return None
+        if saved_stats != self.storage.file_stats():
+            print("Resume data is stale, files changed since the last run")
+            return None
+        return Bitfield.from_bytes(data['pieces'], self.torrent.num_pieces)
+
+    def save(self, completed_pieces):
+        # call after the storage is closed so the recorded mtimes are final
+        data = {
+            'info hash': self.torrent.info_hash,
+            'pieces': completed_pieces.to_bytes(),
+            'files': [list(stat) if stat else 0 for stat in self.storage.file_stats()],
+        }
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(Bencode.encode(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+
+def recheck(torrent, storage, executor, batch = 64, report_interval = 1.0):
+    """Hash every piece already on disk in parallel and return the valid ones.
+
+    Files are read through read-only mmaps so the worker threads hash straight
+    out of the page cache; hashlib drops the GIL while it does.
+    """
+    maps = storage.map_files()
+    views = [memoryview(m) if m is not None else None for m in maps]
+
+    def check(first):
+        valid = []
+        for piece_index in range(first, min(first + batch, torrent.num_pieces)):
+            sha1 = hashlib.sha1()
+            offset = piece_index * torrent.piece_length
+            for index, file_offset, chunk in storage.segments(offset, torrent.get_pieces_size(piece_index)):
+                sha1.update(views[index][file_offset:file_offset + chunk])
+            if sha1.digest() == torrent.pieces_hash[piece_index]:
+                valid.append(piece_index)
+        return valid
+
+    start = time.monotonic()
+    last_report = start
+    valid = set()
+    try:
+        batches = range(0, torrent.num_pieces, batch)
+        for done, result in enumerate(executor.map(check, batches), 1):
+            valid.update(result)
+            now = time.monotonic()
+            if now - last_report >= report_interval:
+                last_report = now
+                checked = min(done * batch, torrent.num_pieces) * torrent.piece_length
+                print(f"Rechecking {done / len(batches):.1%} - {checked / (now - start) / 1e9:.2f} GB/s")
+    finally:
+        for view in views:
+            if view is not None:
+                view.release()
+        for m in maps:
+            if m is not None:
+                m.close()
+    elapsed = max(time.monotonic() - start, 1e-9)
+    print(f"Recheck done: {len(valid)} of {torrent.num_pieces} pieces valid, "
+          f"{torrent.length / 1e9:.2f} GB at {torrent.length / elapsed / 1e9:.2f} GB/s")
+    return valid
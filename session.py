@@ -0,0 +1,136 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from client import BitTorrentClient
+from engine import PeerEngine
+from hasher import HashPool
+from listener import PeerListener
+from ratelimit import RateLimiter
+
+
+class Session:
+    """Run many torrents in one process.
+
+    All torrents share one event loop, listening socket, rate limiter, hash
+    pool, disk writer and tracker thread pool. At most max_active_downloads
+    torrents download at once, the others wait in a queue ordered by
+    priority (higher first, then in the order they were added). Finished
+    torrents keep seeding without taking a download slot. The connection
+    budget is split between running torrents in proportion to priority + 1
+    (priorities below 0 weigh as 0).
+    """
+
+    SCHEDULE_INTERVAL = 1
+    MIN_PEERS = 5 # per running torrent, however many there are
+
+    def __init__(self, download_dir = '.', port = 6681, max_active_downloads = 4, max_connections = 200,
+                 upload_rate = 0, download_rate = 0):
+        self.download_dir = download_dir
+        self.max_active_downloads = max_active_downloads
+        self.max_connections = max_connections
+
+        self.engine = PeerEngine()
+        self.listener = PeerListener(port)
+        self.rate_limiter = RateLimiter(upload_rate, download_rate)
+        self.hasher = HashPool()
+        self.disk_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk')
+        self.tracker_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='tracker')
+
+        # info_hash -> client, in the order torrents were added
+        self.torrents = {}
+        self.priorities = {}
+        self.active = set()
+        self.lock = threading.RLock()
+        self.running = False
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def add(self, torrent_file, priority = 0, download_dir = None):
+        """Queue a torrent, return its client"""
+        client = BitTorrentClient(torrent_file, engine=self.engine, download_dir=download_dir or self.download_dir,
+                                  listener=self.listener, rate_limiter=self.rate_limiter, hasher=self.hasher,
+                                  disk_writer=self.disk_writer, tracker_executor=self.tracker_executor)
+        info_hash = client.torrent.info_hash
+        with self.lock:
+            if info_hash in self.torrents:
+                raise ValueError(f"{client.torrent.name} is already in the session")
+            self.torrents[info_hash] = client
+            self.priorities[info_hash] = priority
+        self.wakeup.set()
+        return client
+
+    def remove(self, info_hash):
+        with self.lock:
+            client = self.torrents.pop(info_hash)
+            self.priorities.pop(info_hash)
+            was_active = info_hash in self.active
+            self.active.discard(info_hash)
+        if was_active:
+            client.stop()
+        self.wakeup.set()
+
+    def set_priority(self, info_hash, priority):
+        with self.lock:
+            self.priorities[info_hash] = priority
+        self.wakeup.set()
+
+    def set_rate_limits(self, upload_rate = None, download_rate = None):
+        # bytes per second across every torrent, 0 lifts the limit
+        self.rate_limiter.set_global(upload_rate, download_rate)
+
+    def queued(self):
+        """Info hashes waiting for a download slot, next to start first"""
+        with self.lock:
+            order = {info_hash: position for position, info_hash in enumerate(self.torrents)}
+            waiting = [info_hash for info_hash in self.torrents if info_hash not in self.active]
+            return sorted(waiting, key=lambda info_hash: (-self.priorities[info_hash], order[info_hash]))
+
+    def start(self):
+        self.running = True
+        self.engine.start()
+        self.thread = threading.Thread(target=self._schedule_loop, name='session', daemon=True)
+        self.thread.start()
+
+    def _schedule_loop(self):
+        while self.running:
+            self.wakeup.clear()
+            try:
+                self.schedule()
+            except Exception as e:
+                print(f"Session schedule error: {e}")
+            self.wakeup.wait(self.SCHEDULE_INTERVAL)
+
+    def schedule(self):
+        """Start queued torrents while download slots are free and rebalance connections"""
+        with self.lock:
+            downloading = sum(1 for info_hash in self.active if not self.torrents[info_hash].is_seeding())
+            starting = [self.torrents[info_hash] for info_hash in self.queued()[:max(self.max_active_downloads - downloading, 0)]]
+            for client in starting:
+                self.active.add(client.torrent.info_hash)
+            self._rebalance()
+        # client start does disk work, keep it out of the lock
+        for client in starting:
+            client.start()
+
+    def _rebalance(self):
+        weights = {info_hash: max(self.priorities[info_hash] + 1, 1) for info_hash in self.active}
+        total = sum(weights.values())
+        for info_hash, weight in weights.items():
+            share = self.max_connections * weight // total
+            self.torrents[info_hash].peer_manager.target_peers = max(share, self.MIN_PEERS)
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            active = [self.torrents[info_hash] for info_hash in self.active]
+            self.active.clear()
+        for client in active:
+            client.stop()
+        if self.engine.loop is not None:
+            self.engine.call(self.listener.close)
+        self.engine.stop()
+        self.hasher.shutdown()
+        self.disk_writer.shutdown(wait=True)
+        self.tracker_executor.shutdown(wait=False, cancel_futures=True)
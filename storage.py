@@ -0,0 +1,192 @@
+import bisect
+import io
+import mmap
+import os
+
+
+class Storage:
+    """Map torrent byte offsets onto the files of a single or multi-file torrent"""
+
+    # buffers per pwritev call, the usual IOV_MAX
+    IOV_MAX = 1024
+
+    def __init__(self, torrent, base_dir = '.', fsync_bytes = 64 << 20):
+        self.torrent = torrent
+        self.base_dir = base_dir
+        self.paths = [self._safe_path(path) for path, _ in torrent.files]
+        self.lengths = [length for _, length in torrent.files]
+
+        # start offset of every file, searched with bisect to find the file
+        # holding any torrent offset
+        self.offsets = []
+        offset = 0
+        for length in self.lengths:
+            self.offsets.append(offset)
+            offset += length
+
+        # fsync is batched: once every fsync_bytes written and on close
+        self.fds = []
+        self.file_objects = []
+        self.fsync_bytes = fsync_bytes
+        self.dirty = set()
+        self.dirty_bytes = 0
+
+    def _safe_path(self, path):
+        # keep every file inside base_dir whatever the torrent says
+        parts = [part for part in path.replace('\\', '/').split('/') if part not in ('', '.')]
+        if not parts or '..' in parts:
+            raise ValueError(f"unsafe path in torrent: {path!r}")
+        return os.path.join(self.base_dir, *parts)
+
+    def open(self):
+        """Create missing files at their final (sparse) size, existing data is kept"""
+        for path, length in zip(self.paths, self.lengths):
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+            if os.fstat(fd).st_size != length:
+                os.ftruncate(fd, length)
+            self.fds.append(fd)
+            # unbuffered views of the same fds, for loop.sendfile
+            self.file_objects.append(io.FileIO(fd, 'r', closefd=False))
+
+    def file_stats(self):
+        """(size, mtime_ns) of every file, None for files that don't exist yet"""
+        stats = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stats.append((st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                stats.append(None)
+        return stats
+
+    def has_data(self):
+        return any(stat and stat[0] for stat in self.file_stats())
+
+    def map_files(self):
+        # read-only maps of every file for bulk hashing, None for empty files
+        return [mmap.mmap(fd, 0, access=mmap.ACCESS_READ) if length else None
+                for fd, length in zip(self.fds, self.lengths)]
+
+    def segments(self, offset, length):
+        # yield (file index, offset in file, length) for a torrent byte range
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        while length > 0 and index < len(self.lengths):
+            file_offset = offset - self.offsets[index]
+            chunk = min(length, self.lengths[index] - file_offset)
+            if chunk > 0:
+                yield index, file_offset, chunk
+                offset += chunk
+                length -= chunk
+            index += 1
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        position = 0
+        for index, file_offset, chunk in self.segments(offset, len(view)):
+            self._pwrite_all(self.fds[index], view[position:position + chunk], file_offset)
+            self.dirty.add(index)
+            position += chunk
+        self.dirty_bytes += len(view)
+        if self.dirty_bytes >= self.fsync_bytes:
+            self.sync()
+
+    def writev(self, offset, buffers):
+        # write consecutive buffers starting at offset, one pwritev per file
+        views = [memoryview(buffer) for buffer in buffers]
+        total = sum(len(view) for view in views)
+        position = 0 # next view, and how much of it went to earlier files
+        used = 0
+        for index, file_offset, chunk in self.segments(offset, total):
+            # the buffers, or parts of them, that land in this file
+            batch = []
+            while chunk:
+                view = views[position][used:]
+                if len(view) <= chunk:
+                    batch.append(view)
+                    chunk -= len(view)
+                    position += 1
+                    used = 0
+                else:
+                    batch.append(view[:chunk])
+                    used += chunk
+                    chunk = 0
+            self._pwritev_all(self.fds[index], batch, file_offset)
+            self.dirty.add(index)
+        self.dirty_bytes += total
+        if self.dirty_bytes >= self.fsync_bytes:
+            self.sync()
+
+    def read(self, offset, length):
+        data = bytearray(length)
+        view = memoryview(data)
+        position = 0
+        for index, file_offset, chunk in self.segments(offset, length):
+            self._pread_into(self.fds[index], view[position:position + chunk], file_offset)
+            position += chunk
+        return data
+
+    @staticmethod
+    def _pwrite_all(fd, view, offset):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    @classmethod
+    def _pwritev_all(cls, fd, views, offset):
+        if not hasattr(os, 'pwritev'):
+            for view in views:
+                cls._pwrite_all(fd, view, offset)
+                offset += len(view)
+            return
+        start = 0
+        while start < len(views):
+            written = os.pwritev(fd, views[start:start + cls.IOV_MAX], offset)
+            offset += written
+            # skip what was written, a short write can end inside a buffer
+            while written:
+                if written >= len(views[start]):
+                    written -= len(views[start])
+                    start += 1
+                else:
+                    views[start] = views[start][written:]
+                    written = 0
+
+    @staticmethod
+    def _pread_into(fd, view, offset):
+        while view:
+            if hasattr(os, 'preadv'):
+                read = os.preadv(fd, [view], offset)
+            else:
+                chunk = os.pread(fd, len(view), offset)
+                read = len(chunk)
+                view[:read] = chunk
+            if not read:
+                raise IOError("short read, file is smaller than the torrent expects")
+            view = view[read:]
+            offset += read
+
+    def write_piece(self, piece_index, data):
+        self.write(piece_index * self.torrent.piece_length, data)
+
+    def read_piece(self, piece_index):
+        return self.read(piece_index * self.torrent.piece_length, self.torrent.get_pieces_size(piece_index))
+
+    def sync(self):
+        # flush every file written since the last sync to disk
+        dirty, self.dirty = self.dirty, set()
+        self.dirty_bytes = 0
+        for index in dirty:
+            os.fsync(self.fds[index])
+
+    def close(self):
+        if not self.fds:
+            return
+        self.sync()
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+        self.file_objects = []
@@ -0,0 +1,104 @@
+import math
+import threading
+import time
+
+
+class TorrentStream:
+    """File-like reader over a torrent that is still downloading.
+
+    Offsets run over the whole torrent with its files back to back, as in
+    Storage. A read blocks only until the pieces it covers are verified. The
+    window of pieces from the read position on gets picker deadlines, so it
+    is fetched ahead of everything else and in order. rate is how many bytes
+    per second the reader consumes, e.g. a media bitrate: with it a window
+    piece is due when the reader will get to it, without it the window is
+    simply fetched in order once the pieces being read are in.
+    """
+
+    def __init__(self, client, window = 16, rate = 0):
+        self.client = client
+        self.window = window
+        self.rate = rate
+        # (read position, pieces a read is blocked on, when it was set),
+        # swapped as a whole since the engine thread reads it
+        self.cursor = (0, range(0), time.monotonic())
+        self.verified = threading.Condition()
+        self.closed = False
+
+    def deadlines(self):
+        """Piece index -> monotonic deadline for the pieces at the read position"""
+        position, waiting, since = self.cursor
+        piece_length = self.client.torrent.piece_length
+        first = min(position // piece_length, self.client.torrent.num_pieces)
+        last = min(max(waiting.stop, first + self.window), self.client.torrent.num_pieces)
+        deadlines = {}
+        for piece_index in range(first, last):
+            if piece_index in waiting:
+                # a reader is blocked on it already
+                deadlines[piece_index] = since
+            elif self.rate:
+                deadlines[piece_index] = since + max(piece_index * piece_length - position, 0) / self.rate
+            else:
+                deadlines[piece_index] = math.inf
+        return deadlines
+
+    def _move(self, position, waiting = range(0)):
+        self.cursor = (position, waiting, time.monotonic())
+        if not self.closed and self.client.engine.loop is not None:
+            self.client.engine.call(self.client.update_deadlines)
+
+    def piece_verified(self, piece_index):
+        # called on the engine thread once the piece can be read back
+        with self.verified:
+            self.verified.notify_all()
+
+    def read(self, offset, n, timeout = None):
+        """Return n bytes at offset, fewer only at the end of the torrent.
+
+        Blocks until every piece they fall in is verified, raises TimeoutError
+        if that takes longer than timeout seconds.
+        """
+        torrent = self.client.torrent
+        n = max(min(n, torrent.length - offset), 0)
+        if self.closed:
+            raise ValueError("read from a closed stream")
+        if not n:
+            return b''
+        pieces = range(offset // torrent.piece_length, (offset + n - 1) // torrent.piece_length + 1)
+        completed = self.client.completed_pieces
+        if not all(piece_index in completed for piece_index in pieces):
+            self._move(offset, pieces)
+            with self.verified:
+                ready = self.verified.wait_for(
+                    lambda: self.closed or all(piece_index in completed for piece_index in pieces), timeout)
+            if self.closed:
+                raise ValueError("stream closed during a read")
+            if not ready:
+                raise TimeoutError(f"pieces {pieces.start}-{pieces.stop - 1} not verified after {timeout}s")
+        # the next read most likely starts where this one ends
+        self._move(offset + n)
+        return self._copy(offset, n)
+
+    def _copy(self, offset, n):
+        # a verified piece sits in the write cache until it can be read from disk
+        torrent = self.client.torrent
+        data = bytearray(n)
+        position = 0
+        while position < n:
+            piece_index, begin = divmod(offset + position, torrent.piece_length)
+            chunk = min(torrent.get_pieces_size(piece_index) - begin, n - position)
+            piece = self.client.write_cache.get(piece_index)
+            if piece is None:
+                piece = self.client.storage.read(offset + position, chunk)
+                begin = 0
+            data[position:position + chunk] = memoryview(piece)[begin:begin + chunk]
+            position += chunk
+        return bytes(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.verified:
+            self.verified.notify_all()
+        self.client.close_stream(self)
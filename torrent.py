@@ -1,30 +1,67 @@
 import hashlib 
+import os
 from bencode import Bencode
 
+class PieceHashes:
+    """Indexable view of the 20-byte SHA-1 hashes packed in the pieces string,
+    slicing on access instead of holding one bytes object per piece"""
+
+    def __init__(self, pieces):
+        if len(pieces) % 20:
+            raise ValueError("Invalid torrent: pieces length is not a multiple of 20")
+        self.pieces = pieces
+
+    def __len__(self):
+        return len(self.pieces) // 20
+
+    def __getitem__(self, piece_index):
+        count = len(self.pieces) // 20
+        if piece_index < 0:
+            piece_index += count
+        if not 0 <= piece_index < count:
+            raise IndexError("piece index out of range")
+        return self.pieces[piece_index * 20:piece_index * 20 + 20]
+
+
 class TorrentFile: 
     def __init__(self, file): 
         with open(file,'rb')as f: 
-            self.data = Bencode.decode(f.read())
-        self.announce = self.data['announce']
+            raw = f.read()
+        # the info hash is taken over the info dict exactly as it appears in
+        # the file, re-encoding could reorder keys and is twice the work
+        self.data, spans = Bencode.decode_spans(raw, ('info',))
+        if 'info' not in spans:
+            raise ValueError("Invalid torrent: no info dictionary")
+        self.announce = self.data.get('announce')
+        # BEP 12 tiers of tracker URLs, the announce URL alone without a list 
+        self.announce_list = []
+        for tier in self.data.get('announce-list') or [[self.announce]]: 
+            urls = [url.decode('utf-8', 'replace') if isinstance(url, bytes) else url for url in tier if url]
+            if urls: 
+                self.announce_list.append(urls)
         self.info = self.data['info']
         self.name = self.info['name']
         self.piece_length = self.info['piece length']
         self.pieces = self.info['pieces']
         
-        # Handle single-file vs multi-file torrents
+        # Handle single-file vs multi-file torrents, files are (path, length) 
+        # in torrent order 
         if 'length' in self.info:
             self.length = self.info['length']
+            self.files = [(os.fsdecode(self.name), self.length)]
         elif 'files' in self.info:
             self.length = sum(f['length'] for f in self.info['files'])
+            self.files = []
+            for f in self.info['files']: 
+                path = os.path.join(os.fsdecode(self.name), *(os.fsdecode(part) for part in f['path']))
+                self.files.append((path, f['length']))
         else:
             raise ValueError("Invalid torrent: no length or files field")
 
-        self.info_hash = hashlib.sha1(Bencode.encode(self.info)).digest() 
-
-        self.pieces_hash = []
-        for i in range(0,len(self.pieces), 20): 
-            self.pieces_hash.append(self.pieces[i:i+20])
+        start, end = spans['info']
+        self.info_hash = hashlib.sha1(memoryview(raw)[start:end]).digest() 
 
+        self.pieces_hash = PieceHashes(self.pieces)
         self.num_pieces = len(self.pieces_hash)
         print(f"load torrent file{self.name}")
         print(f'Pieces: {self.num_pieces}, Piece Length: {self.piece_length}')
@@ -1,27 +1,169 @@
+import http.client 
 import random 
+import socket 
 import struct 
+import threading 
+import time 
 import urllib.parse 
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from bencode import Bencode
+from metrics import REGISTRY 
+from udp_tracker import TrackerError, UDPTracker
+
+ANNOUNCE_TIME = REGISTRY.histogram('bt_tracker_announce_seconds', 'Time of announces to one tracker, failed ones included')
+
+class Tracker: 
+    """Announce state of a single tracker URL"""
+
+    def __init__(self, url): 
+        self.url = url 
+        self.interval = 1800 
+        self.min_interval = 0 
+        self.last_announce = None 
+        self.failures = 0 
+        self.started = False 
+        self.udp = UDPTracker(url, base_timeout=TrackerClient.UDP_TIMEOUT, max_retries=TrackerClient.UDP_RETRIES) if url.startswith('udp://') else None 
+        self.http = None 
+
+    def session(self): 
+        if self.http is None: 
+            self.http = HTTPSession(self.url)
+        return self.http 
+
+    def close(self): 
+        if self.udp: 
+            self.udp.close()
+        if self.http: 
+            self.http.close()
+
+    def next_announce(self, need_peers): 
+        # regular announces follow the tracker's interval, a client short of 
+        # peers may come back sooner but never before min interval 
+        if self.last_announce is None: 
+            return 0 
+        wait = self.min_interval if need_peers and not self.failures else self.interval 
+        return self.last_announce + wait 
+
+    def succeeded(self, response, now): 
+        self.failures = 0 
+        self.last_announce = now 
+        self.interval = response.get('interval', 1800)
+        # without a min interval, early announces are spaced like they used to be 
+        self.min_interval = min(response.get('min interval', 300), self.interval)
+
+    def failed(self, now): 
+        # back off 1, 2, 4 ... minutes up to the regular interval 
+        self.failures += 1 
+        self.last_announce = now 
+        self.interval = min(60 * 2 ** (self.failures - 1), 1800)
 
 class TrackerClient: 
-    def __init__(self, torrent): 
+    # BEP 15 retransmits after 15 * 2**n seconds, fewer retries keep a dead 
+    # tracker from holding up the announce round for long 
+    UDP_TIMEOUT = 15 
+    UDP_RETRIES = 2 
+    HTTP_TIMEOUT = 30 
+    STOP_TIMEOUT = 5 
+
+    def __init__(self, torrent, executor = None): 
         self.torrent = torrent 
         self.peer_id = self._generate_peer_id() 
         self.port = 6681 
+        self.key = random.getrandbits(32)
+        self.num_want = 200 
+
+        # BEP 12: tiers are announced to concurrently, within a tier trackers 
+        # are tried in random order and the one that answers moves to the front 
+        self.tiers = []
+        for urls in torrent.announce_list: 
+            tier = []
+            for url in urls: 
+                if not url.startswith(('http://', 'https://', 'udp://')): 
+                    continue 
+                # one malformed entry must not keep the torrent from loading 
+                try: 
+                    tier.append(Tracker(url))
+                except (TrackerError, ValueError) as e: 
+                    print(f"Skipping tracker {url}: {e}")
+            random.shuffle(tier)
+            if tier: 
+                self.tiers.append(tier)
+        # a session shares one pool between all of its torrents 
+        self.owns_executor = executor is None 
+        self.executor = executor or ThreadPoolExecutor(max_workers=max(len(self.tiers), 1), thread_name_prefix='tracker')
     
     def _generate_peer_id(self): 
         return b'-PC0001-' + bytes([random.randint(0, 255) for _ in range(12)])
     
-    def announce(self, uploaded = 0, downloaded = 0, left = None, event= 'started'): 
+    def announce(self, uploaded = 0, downloaded = 0, left = None, event= 'started', need_peers = True, on_peers = None): 
+        """Announce to every tier that is due, return the merged peers and the 
+        seconds until the next tracker is due. on_peers(peers) is called with 
+        each tier's peers as soon as that tier answers, so a dead tracker in 
+        one tier doesn't hold back the peers of the others"""
         if left is None: 
             left = self.torrent.length 
+        futures = [self.executor.submit(self._announce_tier, tier, uploaded, downloaded, left, event, need_peers)
+                   for tier in self.tiers]
+
+        # the same peer is usually listed by several trackers 
+        peers = {}
+        for future in as_completed(futures): 
+            tier_peers = future.result()
+            if tier_peers and on_peers: 
+                on_peers(tier_peers)
+            for peer in tier_peers: 
+                peers.setdefault(peer, None)
+        peers = list(peers)
+
+        now = time.monotonic()
+        next_announce = min((tier[0].next_announce(need_peers) for tier in self.tiers), default=now + 1800)
+        if futures: 
+            print(f"Found {len(peers)} peers from {len(self.tiers)} tracker tiers ")
+        return peers, max(next_announce - now, 1)
 
-        # Ensure announce URL is a string
-        announce_url = self.torrent.announce
-        if isinstance(announce_url, bytes):
-            announce_url = announce_url.decode('utf-8')
+    def _announce_tier(self, tier, uploaded, downloaded, left, event, need_peers): 
+        now = time.monotonic()
+        if event == 'stopped': 
+            # only trackers that know about us need to hear we are leaving 
+            trackers = [tracker for tracker in tier if tracker.started][:1]
+        elif now < tier[0].next_announce(need_peers) and event != 'completed': 
+            return []
+        else: 
+            trackers = list(tier)
+        for tracker in trackers: 
+            tracker_event = event 
+            if event == 'started' and tracker.started: 
+                tracker_event = ''
+            started_at = time.monotonic()
+            try: 
+                response = self._announce_to(tracker, uploaded, downloaded, left, tracker_event)
+                peers = self._parse_peers(response.get('peers', b''))
+                peers += self._parse_peers(response.get('peers6', b''), ipv6=True)
+            except Exception as e: 
+                print(f"Tracker request to {tracker.url} failed: {e}")
+                tracker.failed(time.monotonic())
+                ANNOUNCE_TIME.observe(time.monotonic() - started_at, outcome='failed')
+                continue 
+            ANNOUNCE_TIME.observe(time.monotonic() - started_at, outcome='ok')
+            tracker.succeeded(response, time.monotonic())
+            tracker.started = event != 'stopped' 
+            tier.remove(tracker)
+            tier.insert(0, tracker)
+            return peers 
+        return []
 
+    def _announce_to(self, tracker, uploaded, downloaded, left, event): 
+        if tracker.udp: 
+            # a 'stopped' announce gets one try within STOP_TIMEOUT, connect included 
+            stopping = event == 'stopped' 
+            return tracker.udp.announce(self.torrent.info_hash, self.peer_id, self.port, uploaded, downloaded,
+                                        left, event, self.key, self.num_want,
+                                        max_retries=0 if stopping else None,
+                                        timeout=self.STOP_TIMEOUT if stopping else None)
+        timeout = self.STOP_TIMEOUT if event == 'stopped' else self.HTTP_TIMEOUT 
+        return self._announce_http(tracker, uploaded, downloaded, left, event, timeout)
+
+    def _announce_http(self, tracker, uploaded, downloaded, left, event, timeout): 
         params = {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id,
@@ -29,75 +171,143 @@ class TrackerClient:
             'uploaded': str(uploaded), 
             'downloaded': str(downloaded), 
             'left': str(left),
-            'event': event,
+            'key': str(self.key),
+            'numwant': str(self.num_want), 
             'compact': '1' 
         }
+        if event: 
+            params['event'] = event 
+        response_data = Bencode.decode(tracker.session().get(tracker.url, params, timeout))
 
-        # Build query string with proper URL encoding
-        query_parts = []
-        for key, value in params.items():
-            if isinstance(value, bytes):
-                encoded_value = urllib.parse.quote(value, safe='')
-            else:
-                encoded_value = urllib.parse.quote(str(value), safe='')
-            query_parts.append(f"{key}={encoded_value}")
-        
-        query = "&".join(query_parts)
-        url = f"{announce_url}?{query}"
-        
-        print(f"Tracker URL: {url}")
+        # Check for failure reason first
+        if 'failure reason' in response_data:
+            failure_reason = response_data['failure reason']
+            if isinstance(failure_reason, bytes):
+                failure_reason = failure_reason.decode('utf-8', 'replace')
+            raise TrackerError(f"Tracker error: {failure_reason}")
         
-        try: 
-            request = urllib.request.Request(url)
-            request.add_header('User-Agent', 'BitTorrent/1.0')
-            response = urllib.request.urlopen(request, timeout=30)
-            response_data = Bencode.decode(response.read())
-            
-            print(f"Tracker response keys: {list(response_data.keys())}")
-            print(f"Tracker response: {response_data}")
-
-            # Handle response keys as bytes or strings
-            failure_key = b'failure reason' if b'failure reason' in response_data else 'failure reason'
-            peers_key = b'peers' if b'peers' in response_data else 'peers'
-            interval_key = b'interval' if b'interval' in response_data else 'interval'
-
-            # Check for failure reason first
-            if failure_key in response_data:
-                failure_reason = response_data[failure_key]
-                if isinstance(failure_reason, bytes):
-                    failure_reason = failure_reason.decode('utf-8')
-                raise Exception(f"Tracker error: {failure_reason}")
-            
-            # Check for peers
-            if peers_key not in response_data:
-                print(f"Available keys: {list(response_data.keys())}")
-                raise Exception("Tracker response missing 'peers' field")
-            
-            peers = self._parse_peers(response_data[peers_key])
-            interval = response_data.get(interval_key, 1800)
-
-            print(f"Found {len(peers)} peers from tracker ")
-            return peers, interval
-        except Exception as e: 
-            print(f"Tracker request failed: {e}")
-            return [], 1800
+        # Check for peers
+        if 'peers' not in response_data and 'peers6' not in response_data:
+            raise TrackerError("Tracker response missing 'peers' field")
+        return response_data
+
+    def scrape(self): 
+        """Swarm counts (complete, incomplete, downloaded) from the first tracker 
+        that answers a scrape, None if none does"""
+        for tier in self.tiers: 
+            for tracker in tier: 
+                try: 
+                    if tracker.udp: 
+                        return tracker.udp.scrape([self.torrent.info_hash])[0]
+                    url = scrape_url(tracker.url)
+                    if url is None: 
+                        continue 
+                    response = Bencode.decode(tracker.session().get(url, {'info_hash': self.torrent.info_hash}, self.HTTP_TIMEOUT))
+                    stats = response['files'][decoded_key(self.torrent.info_hash)]
+                    return {key: stats.get(key, 0) for key in ('complete', 'incomplete', 'downloaded')}
+                except Exception as e: 
+                    print(f"Scrape of {tracker.url} failed: {e}")
+        return None
+
+    def close(self): 
+        if self.owns_executor: 
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        for tier in self.tiers: 
+            for tracker in tier: 
+                tracker.close()
     
-    def _parse_peers(self, peers_data): 
-        peers = [] 
+    def _parse_peers(self, peers_data, ipv6 = False): 
         if isinstance(peers_data, list):
             # Dictionary format (non-compact)
+            peers = [] 
             for peer_dict in peers_data:
-                ip_key = b'ip' if b'ip' in peer_dict else 'ip'
-                port_key = b'port' if b'port' in peer_dict else 'port'
-                ip = peer_dict.get(ip_key, b'').decode() if isinstance(peer_dict.get(ip_key, ''), bytes) else peer_dict.get(ip_key, '')
-                port = peer_dict.get(port_key, 0)
-                peers.append((ip, port))
-        else:
-            # Compact format (binary)
-            for i in range(0, len(peers_data), 6): 
-                ip_bytes = peers_data[i:i+4]
-                port_bytes = peers_data[i+4:i+6]
-                ip = '.'.join(str(b) for b in ip_bytes)
-                port = struct.unpack('>H', port_bytes)[0]
-                peers.append((ip, port))
-        return peers
\ No newline at end of file
+                ip = peer_dict.get('ip', '')
+                if isinstance(ip, bytes): 
+                    ip = ip.decode('utf-8', 'replace')
+                peers.append((ip, peer_dict.get('port', 0)))
+            return peers 
+        # Compact format (binary)
+        return parse_compact_peers(peers_data, ipv6)
+
+
+def parse_compact_peers(data, ipv6 = False): 
+    """Decode a compact peer string: 4 (or 16 for peers6) address bytes and a 
+    big-endian port per peer, a trailing partial entry is ignored"""
+    size, family, layout = (18, socket.AF_INET6, '!16sH') if ipv6 else (6, socket.AF_INET, '!4sH')
+    view = memoryview(data)
+    view = view[:len(view) - len(view) % size]
+    ntop = socket.inet_ntop 
+    return [(ntop(family, address), port) for address, port in struct.iter_unpack(layout, view)]
+
+
+def decoded_key(key): 
+    # how Bencode.decode returns a binary dict key: str if it is valid UTF-8 
+    try: 
+        return key.decode('utf-8')
+    except UnicodeDecodeError: 
+        return key 
+
+
+def scrape_url(announce_url): 
+    # BEP 48: only announce URLs whose last path part starts with 'announce' 
+    # have a scrape counterpart 
+    parts = urllib.parse.urlsplit(announce_url)
+    head, _, last = parts.path.rpartition('/')
+    if not last.startswith('announce'): 
+        return None 
+    return urllib.parse.urlunsplit(parts._replace(path=f"{head}/scrape{last[len('announce'):]}"))
+
+
+class HTTPSession: 
+    """Keep-alive connection to one HTTP tracker, reused across announces and scrapes"""
+
+    def __init__(self, url): 
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https' 
+        self.host = parts.hostname 
+        self.port = parts.port 
+        self.conn = None 
+        # an announce and a scrape may want the connection at the same time 
+        self.lock = threading.Lock()
+
+    def get(self, url, params, timeout): 
+        """GET url with params appended to its query, return the body"""
+        parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
+        if parts.query: 
+            query = f"{parts.query}&{query}"
+        target = f"{parts.path or '/'}?{query}"
+        with self.lock: 
+            return self._get(target, timeout)
+
+    def _get(self, target, timeout): 
+        for attempt in range(2): 
+            reused = self.conn is not None 
+            if self.conn is None: 
+                connection = http.client.HTTPSConnection if self.https else http.client.HTTPConnection 
+                self.conn = connection(self.host, self.port, timeout=timeout)
+            elif self.conn.sock is not None: 
+                self.conn.sock.settimeout(timeout)
+            try: 
+                self.conn.request('GET', target, headers={'User-Agent': 'BitTorrent/1.0', 'Accept-Encoding': 'identity'})
+                response = self.conn.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionError) as e: 
+                # the tracker may have closed the idle connection, redial once 
+                self.close()
+                if reused and not attempt: 
+                    continue 
+                raise TrackerError(f"connection to {self.host} failed: {e}") from e 
+            except Exception: 
+                self.close()
+                raise 
+            if response.will_close: 
+                self.close()
+            if response.status != 200: 
+                raise TrackerError(f"HTTP {response.status} {response.reason} from {self.host}")
+            return body 
+
+    def close(self): 
+        if self.conn is not None: 
+            self.conn.close()
+            self.conn = None 
@@ -0,0 +1,135 @@
+import math
+import random
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+
+
+class TrackerError(Exception):
+    pass
+
+
+class UDPTracker:
+    """BEP 15 UDP tracker client.
+
+    Every request is retransmitted after base_timeout * 2**n seconds, as the
+    spec asks. The connection id is cached for a minute and a single socket
+    is kept per tracker so the id stays tied to the same address.
+    """
+
+    PROTOCOL_ID = 0x41727101980
+    CONNECT = 0
+    ANNOUNCE = 1
+    SCRAPE = 2
+    ERROR = 3
+    EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+    CONNECTION_ID_TTL = 60
+
+    def __init__(self, url, base_timeout = 15, max_retries = 8):
+        parsed = urllib.parse.urlsplit(url)
+        if not parsed.hostname or not parsed.port:
+            raise TrackerError(f"invalid UDP tracker URL: {url}")
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_timeout = base_timeout
+        self.max_retries = max_retries
+        self.sock = None
+        self.family = None
+        self.connection_id = None
+        self.connected_at = 0.0
+        # one transaction at a time, replies are matched by transaction id
+        self.lock = threading.Lock()
+
+    def _socket(self):
+        if self.sock is None:
+            family, _, _, _, address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_DGRAM)[0]
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.connect(address)
+            self.sock, self.family = sock, family
+        return self.sock
+
+    def _exchange(self, build, action, timeout):
+        # send one request and wait for the reply carrying its transaction id
+        sock = self._socket()
+        transaction_id = random.getrandbits(32)
+        sock.send(build(transaction_id))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout()
+            sock.settimeout(remaining)
+            data = sock.recv(65536)
+            if len(data) < 8:
+                continue
+            reply_action, reply_id = struct.unpack_from('>II', data)
+            if reply_id != transaction_id:
+                continue # a late reply to an earlier transmission
+            if reply_action == self.ERROR:
+                raise TrackerError(data[8:].decode('utf-8', 'replace'))
+            if reply_action != action:
+                raise TrackerError(f"unexpected action {reply_action} from {self.host}:{self.port}")
+            return data
+
+    def _connect(self, timeout):
+        data = self._exchange(lambda transaction_id: struct.pack('>QII', self.PROTOCOL_ID, self.CONNECT, transaction_id),
+                              self.CONNECT, timeout)
+        if len(data) < 16:
+            raise TrackerError("short connect response")
+        self.connection_id = struct.unpack_from('>Q', data, 8)[0]
+        self.connected_at = time.monotonic()
+
+    def _request(self, build, action, max_retries, timeout = None):
+        # retransmit with exponential backoff, reconnecting when the cached
+        # connection id has expired. timeout bounds the whole request, a
+        # connect included, e.g. for a 'stopped' announce on the way out
+        if max_retries is None:
+            max_retries = self.max_retries
+        deadline = math.inf if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            for attempt in range(max_retries + 1):
+                wait = self.base_timeout * 2 ** attempt
+                try:
+                    if self.connection_id is None or time.monotonic() - self.connected_at > self.CONNECTION_ID_TTL:
+                        self._connect(min(wait, deadline - time.monotonic()))
+                    return self._exchange(build, action, min(wait, deadline - time.monotonic()))
+                except socket.timeout:
+                    if time.monotonic() >= deadline:
+                        break
+                    continue
+                except TrackerError:
+                    self.connection_id = None
+                    raise
+            self.connection_id = None
+            raise TrackerError(f"no response from {self.host}:{self.port}")
+
+    def announce(self, info_hash, peer_id, port, uploaded, downloaded, left, event = '', key = 0,
+                 num_want = -1, max_retries = None, timeout = None):
+        """Return the tracker's response as a dict shaped like an HTTP tracker's"""
+        def build(transaction_id):
+            return struct.pack('>QII20s20sQQQIIIiH', self.connection_id, self.ANNOUNCE, transaction_id,
+                               info_hash, peer_id, downloaded, left, uploaded,
+                               self.EVENTS.get(event, 0), 0, key, num_want, port)
+        data = self._request(build, self.ANNOUNCE, max_retries, timeout)
+        if len(data) < 20:
+            raise TrackerError("short announce response")
+        interval, leechers, seeders = struct.unpack_from('>III', data, 8)
+        # peers come in the address family the request went over
+        peers_key = 'peers6' if self.family == socket.AF_INET6 else 'peers'
+        return {'interval': interval, 'incomplete': leechers, 'complete': seeders, peers_key: data[20:]}
+
+    def scrape(self, info_hashes, max_retries = None):
+        """Return complete, downloaded and incomplete counts for each info hash"""
+        def build(transaction_id):
+            return struct.pack('>QII', self.connection_id, self.SCRAPE, transaction_id) + b''.join(info_hashes)
+        data = self._request(build, self.SCRAPE, max_retries)
+        return [{'complete': complete, 'downloaded': downloaded, 'incomplete': incomplete}
+                for complete, downloaded, incomplete in struct.iter_unpack('>III', data[8:8 + 12 * len(info_hashes)])]
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.connection_id = None
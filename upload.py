@@ -0,0 +1,115 @@
+import asyncio
+import struct
+from collections import OrderedDict
+
+
+class PieceCache:
+    """LRU cache of whole pieces bounded by a total byte budget"""
+
+    def __init__(self, max_bytes = 64 << 20):
+        self.max_bytes = max_bytes
+        self.pieces = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, piece_index):
+        data = self.pieces.get(piece_index)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pieces.move_to_end(piece_index)
+        return data
+
+    def put(self, piece_index, data):
+        if len(data) > self.max_bytes:
+            return
+        self.discard(piece_index)
+        self.pieces[piece_index] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, piece_index):
+        data = self.pieces.pop(piece_index, None)
+        if data is not None:
+            self.size -= len(data)
+
+
+class Uploader:
+    """Answer block requests from verified pieces on disk.
+
+    Pieces in the read cache are sent from memory. A piece only gets read into
+    the cache once a second peer asks for it; blocks of cold pieces go from
+    the page cache to the socket with sendfile instead. Pieces that were just
+    downloaded are cached as they are written and can also be found in the
+    write cache until they reach the disk. Disk reads run on the disk writer's
+    thread so they are ordered after any pending write of the piece.
+    """
+
+    # pieces remembered as recently requested but not cached
+    RECENT_PIECES = 1024
+
+    def __init__(self, torrent, storage, disk_executor, cache_size = 64 << 20, write_cache = None):
+        self.torrent = torrent
+        self.storage = storage
+        self.disk_executor = disk_executor
+        self.write_cache = write_cache
+        self.cache = PieceCache(cache_size)
+        self.recent = OrderedDict()
+        self.unwritten = set()
+        self.use_sendfile = True
+
+    def add_piece(self, piece_index, data):
+        # a verified piece on its way to disk, peers we announce it to will want it
+        self.unwritten.add(piece_index)
+        self.cache.put(piece_index, data)
+
+    def piece_written(self, piece_index):
+        # called on the disk thread once the piece is on disk
+        self.unwritten.discard(piece_index)
+
+    def _admit(self, piece_index, peer):
+        # cache a piece the second time a different peer asks for it
+        peer_key = (peer.ip, peer.port)
+        first = self.recent.get(piece_index)
+        if first is None:
+            self.recent[piece_index] = peer_key
+            if len(self.recent) > self.RECENT_PIECES:
+                self.recent.popitem(last=False)
+            return False
+        return first != peer_key
+
+    async def send_block(self, peer, piece_index, begin, length):
+        """Write one PIECE message to the peer's transport"""
+        loop = asyncio.get_running_loop()
+        header = struct.pack('!IBII', 9 + length, peer.PIECE, piece_index, begin)
+        data = self.cache.get(piece_index)
+        if data is None and self.write_cache is not None:
+            data = self.write_cache.get(piece_index)
+        if data is None and (piece_index in self.unwritten or self._admit(piece_index, peer) or not self.use_sendfile):
+            data = await loop.run_in_executor(self.disk_executor, self.storage.read_piece, piece_index)
+            self.recent.pop(piece_index, None)
+            self.cache.put(piece_index, data)
+            if not peer.connected:
+                return
+        if data is not None:
+            # transports write the pair with sendmsg where the loop supports it
+            peer.transport.writelines([header, memoryview(data)[begin:begin + length]])
+            return
+
+        peer.transport.write(header)
+        offset = piece_index * self.torrent.piece_length + begin
+        for index, file_offset, chunk in self.storage.segments(offset, length):
+            try:
+                await loop.sendfile(peer.transport, self.storage.file_objects[index], file_offset, chunk, fallback=False)
+            except asyncio.SendfileNotAvailableError:
+                # e.g. no os.sendfile on this platform, read the rest instead
+                self.use_sendfile = False
+                rest = await loop.run_in_executor(self.disk_executor, self.storage.read, offset, length)
+                peer.transport.write(rest)
+                return
+            offset += chunk
+            length -= chunk
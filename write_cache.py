@@ -0,0 +1,98 @@
+import threading
+import time
+from metrics import REGISTRY
+
+WRITE_TIME = REGISTRY.histogram('bt_disk_write_seconds', 'Time of each coalesced write of consecutive pieces')
+WRITTEN = REGISTRY.counter('bt_disk_written_bytes_total', 'Bytes written by write cache flushes')
+
+
+class WriteCache:
+    """Write-back cache for verified pieces.
+
+    Pieces are held in memory and written in batches on the disk writer's
+    thread: runs of consecutive pieces go out as one pwritev per file instead
+    of one write per piece. A flush starts once the cache holds max_bytes or
+    its oldest piece has waited flush_interval seconds, and always on close.
+    """
+
+    def __init__(self, storage, executor, max_bytes = 32 << 20, flush_interval = 2.0, on_written = None):
+        self.storage = storage
+        self.executor = executor
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        # called on the disk thread with the index of every piece written
+        self.on_written = on_written
+        self.lock = threading.Lock()
+        self.pieces = {}
+        self.size = 0
+        self.oldest = None
+        self.flush_pending = False
+        self.flushes = 0
+
+    def add(self, piece_index, data):
+        with self.lock:
+            if piece_index in self.pieces:
+                return
+            self.pieces[piece_index] = data
+            self.size += len(data)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            full = self.size >= self.max_bytes
+        if full:
+            self.schedule_flush()
+
+    def get(self, piece_index):
+        # a piece that is not on disk yet
+        with self.lock:
+            return self.pieces.get(piece_index)
+
+    def tick(self, now = None):
+        """Start a flush if the oldest piece has waited long enough"""
+        now = now or time.monotonic()
+        if self.oldest is not None and now - self.oldest >= self.flush_interval:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        with self.lock:
+            if self.flush_pending or not self.pieces:
+                return None
+            self.flush_pending = True
+        return self.executor.submit(self.flush)
+
+    def flush(self):
+        """Write every cached piece, runs on the disk thread"""
+        with self.lock:
+            self.flush_pending = False
+            pieces = dict(self.pieces)
+            self.oldest = None
+        if not pieces:
+            return
+        self.flushes += 1
+        piece_length = self.storage.torrent.piece_length
+        indexes = sorted(pieces)
+        start = 0
+        for position in range(1, len(indexes) + 1):
+            if position < len(indexes) and indexes[position] == indexes[position - 1] + 1:
+                continue
+            run = indexes[start:position]
+            buffers = [pieces[piece_index] for piece_index in run]
+            started_at = time.perf_counter()
+            self.storage.writev(run[0] * piece_length, buffers)
+            WRITE_TIME.observe(time.perf_counter() - started_at)
+            WRITTEN.inc(sum(len(buffer) for buffer in buffers))
+            start = position
+        # pieces leave the cache only once they can be read back from disk
+        with self.lock:
+            for piece_index in indexes:
+                data = self.pieces.pop(piece_index, None)
+                if data is not None:
+                    self.size -= len(data)
+            if self.pieces and self.oldest is None:
+                self.oldest = time.monotonic()
+        if self.on_written:
+            for piece_index in indexes:
+                self.on_written(piece_index)
+
+    def close(self):
+        # write out whatever is left, after any flush already queued
+        self.executor.submit(self.flush).result()